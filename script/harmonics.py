@@ -0,0 +1,110 @@
+# coding=UTF-8
+# Harmonic distortion of raw V/I captures.
+# Sparse DFT only on fundamental and first harmonics of ncycle,
+# cheap enough for every adcRequestData capture.
+import math
+import numpy as np
+
+import smath
+
+DEFAULT_HARMONICS = 10
+#THD of current above THD of voltage, DUT is considered nonlinear
+THD_NONLINEAR_LIMIT = 0.01
+
+def harmonicBasis(ncycle, N, count):
+	'''
+		return (count, N) complex matrix, row k-1 is exp(j*2*pi*k*i/ncycle)
+		Shared and read-only, see smath.cachedBasis.
+	'''
+	def make():
+		phase = smath.phaseBasis(ncycle, N)
+		k = np.arange(1, count+1).reshape(count, 1)
+		return (np.exp(1j*k*phase),)
+	return smath.cachedBasis(('harmonic', ncycle, N, count), make)[0]
+
+def maxHarmonics(ncycle):
+	'''
+		Harmonics below Nyquist frequency.
+	'''
+	return max((ncycle-1)//2, 1)
+
+def analyze(data, ncycle, harmonics=DEFAULT_HARMONICS):
+	'''
+		data - raw samples of one channel, whole number of periods.
+		return dict
+			c0 - mean
+			phasors - list of complex(sin, cos) for harmonics 1..n, like calcFast
+			amplitudes - abs of phasors
+			noise - sigma of samples left after removing harmonics
+			thd - sqrt(sum of squared amplitudes of harmonics 2..n)/amplitude of fundamental,
+				expected noise power is subtracted, so noise alone gives thd near 0
+			thd_floor - smaller thd may be caused by noise alone (5 sigma)
+	'''
+	x = np.asarray(data, dtype=np.float64)
+	N = len(x)
+	count = min(harmonics, maxHarmonics(ncycle))
+	c0 = x.mean()
+	x = x-c0
+
+	S = harmonicBasis(ncycle, N, count).dot(x)*(2.0/N)
+	#sum(x*cos)+j*sum(x*sin) -> complex(sin, cos)
+	phasors = S.imag+1j*S.real
+	amplitudes = np.abs(phasors)
+	power = amplitudes*amplitudes
+
+	#every harmonic is amplitude^2/2 of signal power, noise gets the rest
+	freedom = max(N-1-2*count, 1)
+	noise2 = max(np.dot(x, x)-N*power.sum()/2, 0)/freedom
+	#expected amplitude^2 of pure noise in one harmonic
+	noisePower = 4*noise2/N
+
+	if amplitudes[0]>0:
+		distortion = max(power[1:].sum()-(count-1)*noisePower, 0)
+		thd = math.sqrt(distortion)/amplitudes[0]
+		thd_floor = math.sqrt(5*math.sqrt(count-1)*noisePower)/amplitudes[0]
+	else:
+		thd = 0.0
+		thd_floor = 0.0
+
+	return {
+		"c0": c0,
+		"phasors": phasors.tolist(),
+		"amplitudes": amplitudes.tolist(),
+		"noise": math.sqrt(noise2),
+		"thd": thd,
+		"thd_floor": thd_floor
+	}
+
+def analyzeCapture(dataV, dataI, ncycle, harmonics=DEFAULT_HARMONICS):
+	'''
+		return {"V": analyze(V), "I": analyze(I), "nonlinear": bool}
+	'''
+	resV = analyze(dataV, ncycle, harmonics)
+	resI = analyze(dataI, ncycle, harmonics)
+	return {
+		"V": resV,
+		"I": resI,
+		"nonlinear": bool(resI['thd']-resV['thd']>max(THD_NONLINEAR_LIMIT, resI['thd_floor']))
+	}
+
+def toJson(result):
+	'''
+		analyzeCapture result without complex numbers, phasors split into sin/cos lists.
+	'''
+	jout = { "nonlinear": result['nonlinear'] }
+	for ch in ('V', 'I'):
+		res = result[ch]
+		jout[ch] = {
+			"thd": res['thd'],
+			"noise": res['noise'],
+			"thd_floor": res['thd_floor'],
+			"sin": [z.real for z in res['phasors']],
+			"cos": [z.imag for z in res['phasors']],
+		}
+	return jout
+
+def analyzeJson(jout, harmonics=DEFAULT_HARMONICS):
+	'''
+		Analyze out.json like capture.
+	'''
+	return analyzeCapture(jout['data']['V'], jout['data']['I'], jout['attr']['ncycle'], harmonics)
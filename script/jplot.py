@@ -6,7 +6,11 @@ import datetime
 import struct
 import sys
 import json
+import os
+import glob
+import bisect
 import smath
+import raw_archive
 
 import matplotlib
 import matplotlib.pyplot as plt
@@ -82,6 +86,15 @@ def readJson(filename):
 		data = json.load(file)
 	return data
 
+def readCapture(fileName):
+	'''
+		Read out.json like capture, 'name.raw@N' is capture N of raw_archive name.
+	'''
+	if '.raw@' in fileName:
+		(name, index) = fileName.rsplit('.raw@', 1)
+		return raw_archive.RawArchive(name).captureJson(int(index))
+	return readJson(fileName)
+
 def makeTimeList(readableData, xmin, xstep):
 	xlist = []
 	for i in xrange(0, len(readableData)):
@@ -108,14 +121,7 @@ def timePerSample(jout):
 	return float(jattr["clock"])/(jattr["period"]/float(jattr["ncycle"]))
 
 def averagePeriod(data, ncycle):
-	adata = [0.0]*ncycle
-	num = len(data)/ncycle
-	for i in xrange(0, len(data)):
-		adata[i%ncycle] += data[i]
-
-	for i in xrange(0, ncycle):
-		adata[i] /= num
-	return adata
+	return smath.foldPeriod(data, ncycle)
 
 def calcFast(period, clock, ncycle, sdata):
 	return complex(sdata["sin"], sdata["cos"])
@@ -158,6 +164,410 @@ def calculateJson(jout):
 	}
 
 
+def sweepColumns(jfreq):
+	'''
+		Vectorized calculateJson for all points of sweep (jout['freq']).
+		return dict of numpy arrays, one element per point:
+			period, clock, ncycle, F, resistor, resistor_index,
+			gain_V, gain_I, gain_index_V, gain_index_I,
+			zV, zI - complex phasors in volts (without gain),
+			R - complex, same as calculateJson()['R'],
+			errorV, errorI - square_error of summary, 0 for raw data points
+	'''
+	n = len(jfreq)
+	cols = {}
+	for key in ('period', 'clock', 'ncycle', 'resistor_index', 'gain_index_V', 'gain_index_I'):
+		cols[key] = np.array([jf['attr'][key] for jf in jfreq], dtype=np.int64).reshape(n)
+	for key in ('resistor', 'gain_V', 'gain_I'):
+		cols[key] = np.array([jf['attr'][key] for jf in jfreq], dtype=np.float64).reshape(n)
+
+	has_summary = np.array(['summary' in jf for jf in jfreq], dtype=bool).reshape(n)
+	summary = [jf['summary'] for jf in jfreq if 'summary' in jf]
+	def summaryColumn(ch, key):
+		return np.array([s[ch][key] for s in summary], dtype=np.float64)
+
+	zV = np.zeros(n, dtype=np.complex128)
+	zI = np.zeros(n, dtype=np.complex128)
+	errorV = np.zeros(n)
+	errorI = np.zeros(n)
+	zV[has_summary] = (summaryColumn('V', 'sin')+1j*summaryColumn('V', 'cos'))*toVolts/cols['gain_V'][has_summary]
+	zI[has_summary] = (summaryColumn('I', 'sin')+1j*summaryColumn('I', 'cos'))*toVolts/cols['gain_I'][has_summary]
+	errorV[has_summary] = summaryColumn('V', 'square_error')
+	errorI[has_summary] = summaryColumn('I', 'square_error')
+
+	for i in np.nonzero(~has_summary)[0]:
+		res = calculateJson(jfreq[i])
+		zV[i] = cmath.rect(*res['fiV'])
+		zI[i] = cmath.rect(*res['fiI'])
+
+	return finishColumns(cols, zV, zI, errorV, errorI)
+
+def finishColumns(cols, zV, zI, errorV, errorI):
+	cols['F'] = cols['clock']/cols['period'].astype(np.float64)
+	cols['zV'] = zV
+	cols['zI'] = zI
+	cols['R'] = (zV/zI)*cols['resistor']
+	cols['errorV'] = errorV
+	cols['errorI'] = errorI
+	return cols
+
+SWEEP_VERSION = 1
+
+def flatColumn(values):
+	'''
+		int64 column if all values are integer, else float64 with nan for missing values
+	'''
+	if all(isinstance(v, (int, long)) for v in values):
+		return np.array(values, dtype=np.int64)
+	return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+
+def writeSweep(fileName, jout):
+	'''
+		Write sweep (jout with 'freq' list) as columnar npz.
+		Columns are named 'attr.<key>', 'summary.V.<key>', 'summary.I.<key>',
+		other scalar fields of jout are stored as 'meta.<key>'.
+		Only points with summary can be stored.
+	'''
+	jfreq = jout['freq']
+	for jf in jfreq:
+		if 'summary' not in jf:
+			raise ValueError('Point without summary can not be stored in '+fileName)
+
+	arrays = { 'version': SWEEP_VERSION, 'count': len(jfreq) }
+	for key in jout:
+		if key!='freq':
+			arrays['meta.'+key] = np.array(jout[key])
+
+	def addColumns(prefix, getDict):
+		keys = set()
+		for jf in jfreq:
+			keys.update(getDict(jf).keys())
+		for key in keys:
+			arrays[prefix+key] = flatColumn([getDict(jf).get(key) for jf in jfreq])
+
+	addColumns('attr.', lambda jf: jf['attr'])
+	addColumns('summary.V.', lambda jf: jf['summary']['V'])
+	addColumns('summary.I.', lambda jf: jf['summary']['I'])
+
+	f = open(fileName, 'wb')
+	np.savez(f, **arrays)
+	f.close()
+	pass
+
+def readSweepArrays(fileName):
+	'''
+		return dict of all columns of npz sweep
+	'''
+	npz = np.load(fileName)
+	arrays = dict((key, npz[key]) for key in npz.files)
+	npz.close()
+	if arrays['version']!=SWEEP_VERSION:
+		raise ValueError('Unknown sweep version in '+fileName)
+	return arrays
+
+def sweepMeta(arrays):
+	meta = {}
+	for key in arrays:
+		if key.startswith('meta.'):
+			meta[key[len('meta.'):]] = arrays[key].tolist()
+	return meta
+
+def readSweep(fileName):
+	'''
+		Read freq.json like sweep from .json or .npz file.
+	'''
+	if not fileName.endswith('.npz'):
+		return readJson(fileName)
+
+	arrays = readSweepArrays(fileName)
+	jout = sweepMeta(arrays)
+	jfreq = [{ 'attr': {}, 'summary': { 'V': {}, 'I': {} } } for i in xrange(int(arrays['count']))]
+	for key in arrays:
+		if key.startswith('attr.') or key.startswith('summary.'):
+			path = key.split('.')
+			values = arrays[key].tolist()
+			for i in xrange(len(jfreq)):
+				d = jfreq[i]
+				for name in path[:-1]:
+					d = d[name]
+				d[path[-1]] = values[i]
+	jout['freq'] = jfreq
+	return jout
+
+def readSweepColumns(fileName):
+	'''
+		return (jout without 'freq', sweepColumns) from .json or .npz file,
+		npz columns are used directly without building per point dicts.
+	'''
+	if not fileName.endswith('.npz'):
+		jout = readJson(fileName)
+		cols = sweepColumns(jout['freq'])
+		meta = dict((key, jout[key]) for key in jout if key!='freq')
+		return (meta, cols)
+
+	arrays = readSweepArrays(fileName)
+	cols = {}
+	for key in ('period', 'clock', 'ncycle', 'resistor_index', 'gain_index_V', 'gain_index_I'):
+		cols[key] = arrays['attr.'+key].astype(np.int64)
+	for key in ('resistor', 'gain_V', 'gain_I'):
+		cols[key] = arrays['attr.'+key].astype(np.float64)
+	zV = (arrays['summary.V.sin']+1j*arrays['summary.V.cos'])*(toVolts/cols['gain_V'])
+	zI = (arrays['summary.I.sin']+1j*arrays['summary.I.cos'])*(toVolts/cols['gain_I'])
+	cols = finishColumns(cols, zV, zI,
+		arrays['summary.V.square_error'].astype(np.float64),
+		arrays['summary.I.square_error'].astype(np.float64))
+	return (sweepMeta(arrays), cols)
+
+def sweepFile(fileName):
+	'''
+		Columnar copy (.npz) of .json sweep is used if it is not older than .json.
+	'''
+	npzName = os.path.splitext(fileName)[0]+'.npz'
+	if not os.path.exists(npzName):
+		return fileName
+	if os.path.exists(fileName) and os.path.getmtime(npzName)<os.path.getmtime(fileName):
+		return fileName
+	return npzName
+
+def convertSweep(fileName, outFileName=None):
+	'''
+		Convert .json sweep to .npz
+		return name of written file
+	'''
+	if outFileName is None:
+		outFileName = os.path.splitext(fileName)[0]+'.npz'
+	writeSweep(outFileName, readJson(fileName))
+	return outFileName
+
+def convertSweeps(fileNames):
+	'''
+		Convert freq.json and cor/*.json sweeps, files without 'freq' are skipped.
+	'''
+	for fileName in fileNames:
+		jout = readJson(fileName)
+		if not isinstance(jout, dict) or 'freq' not in jout:
+			continue
+		print fileName, '->', convertSweep(fileName)
+	pass
+
+def joinSweeps(cols0, role0, cols1, role1):
+	'''
+		Calibration points measured by two sweeps on the same periods.
+		return dict of arrays sorted by period: period, F (of cols0), role0 and role1 - R of both sweeps
+	'''
+	(period, i0, i1) = np.intersect1d(cols0['period'], cols1['period'], return_indices=True)
+	return { 'period': period, 'F': cols0['F'][i0], role0: cols0['R'][i0], role1: cols1['R'][i1] }
+
+def calibrationR(columns, gain, period, role):
+	'''
+		R of one calibration point of corrector columns {gain: joinSweeps}
+	'''
+	cur = columns[gain]
+	i = np.searchsorted(cur['period'], period)
+	if i>=len(cur['period']) or cur['period'][i]!=period:
+		raise KeyError(period)
+	return complex(cur[role][i])
+
+CORRECTOR_CACHE = 'cor/corrector.npz'
+CORRECTOR_CACHE_VERSION = 2
+CORRECTOR_SHORT = 0
+CORRECTOR_OPEN = 1
+CORRECTOR_ROLES = ['short', 'load', 'open', 'min', 'max']
+MAX_GAIN_INDEX = 8
+
+def correctorSources(corDir='cor'):
+	'''
+		Calibration files and their (mtime, size), compiled cache is valid while they are the same.
+	'''
+	names = glob.glob(os.path.join(corDir, '*.json'))+glob.glob(os.path.join(corDir, '*.npz'))
+	names = sorted(name for name in names if os.path.basename(name)!=os.path.basename(CORRECTOR_CACHE))
+	return {
+		"name": np.array(names, dtype=str),
+		"mtime": np.array([os.path.getmtime(name) for name in names], dtype=np.float64),
+		"size": np.array([os.path.getsize(name) for name in names], dtype=np.int64)
+	}
+
+def readCompiledCorrector(fileName, sources):
+	'''
+		return dict of arrays written by writeCompiledCorrector, None if absent or outdated
+	'''
+	if not os.path.exists(fileName):
+		return None
+	npz = np.load(fileName)
+	compiled = dict((key, npz[key]) for key in npz.files)
+	npz.close()
+
+	if compiled['version']!=CORRECTOR_CACHE_VERSION:
+		return None
+	for key in ('name', 'mtime', 'size'):
+		if not np.array_equal(compiled['sources_'+key], sources[key]):
+			return None
+	return compiled
+
+def writeCompiledCorrector(fileName, sources, corrector):
+	'''
+		Flatten calibration columns of Corrector to (kind, diapazon, gain, role, period, F, R).
+	'''
+	rows = dict((key, []) for key in ('kind', 'diapazon', 'gain', 'role', 'period', 'F', 'R'))
+	def addColumns(kind, diapazon, columns):
+		for gain in columns:
+			cur = columns[gain]
+			n = len(cur['period'])
+			for role in cur:
+				if role not in CORRECTOR_ROLES:
+					continue
+				rows['kind'].append(np.full(n, kind))
+				rows['diapazon'].append(np.full(n, diapazon))
+				rows['gain'].append(np.full(n, gain))
+				rows['role'].append(np.full(n, CORRECTOR_ROLES.index(role)))
+				rows['period'].append(cur['period'])
+				rows['F'].append(cur['F'])
+				rows['R'].append(cur[role])
+
+	addColumns(CORRECTOR_SHORT, 0, corrector.corr_short.columns)
+	open_R = np.zeros((len(corrector.corr), MAX_GAIN_INDEX))
+	for diapazon in xrange(len(corrector.corr)):
+		corr = corrector.corr[diapazon]
+		addColumns(CORRECTOR_OPEN, diapazon, corr.columns)
+		for i in corr.R:
+			open_R[diapazon][i] = corr.R[i]
+
+	def column(key, dtype):
+		if not rows[key]:
+			return np.zeros(0, dtype=dtype)
+		return np.concatenate(rows[key]).astype(dtype)
+
+	f = open(fileName, 'wb')
+	np.savez(f,
+		version=CORRECTOR_CACHE_VERSION,
+		sources_name=sources['name'],
+		sources_mtime=sources['mtime'],
+		sources_size=sources['size'],
+		kind=column('kind', np.int8),
+		diapazon=column('diapazon', np.int8),
+		gain=column('gain', np.int8),
+		role=column('role', np.int8),
+		period=column('period', np.int64),
+		F=column('F', np.float64),
+		R=column('R', np.complex128),
+		open_R=open_R,
+		open_C=corrector.corr[0].C,
+		short_R1=corrector.corr_short.R1,
+		short_R100=corrector.corr_short.R100)
+	f.close()
+	pass
+
+def compiledColumns(compiled, kind, diapazon):
+	'''
+		Restore columns {gain: {'period', 'F', role: R}} of one corrector, like joinSweeps.
+	'''
+	columns = {}
+	m = (compiled['kind']==kind) & (compiled['diapazon']==diapazon)
+	for gain in np.unique(compiled['gain'][m]).tolist():
+		mg = m & (compiled['gain']==gain)
+		cur = {}
+		for role in np.unique(compiled['role'][mg]).tolist():
+			idx = np.nonzero(mg & (compiled['role']==role))[0]
+			idx = idx[np.argsort(compiled['period'][idx], kind='mergesort')]
+			cur['period'] = compiled['period'][idx]
+			cur['F'] = compiled['F'][idx]
+			cur[CORRECTOR_ROLES[role]] = compiled['R'][idx]
+		columns[gain] = cur
+	return columns
+
+class CorrectionTable:
+	'''
+		Correction coefficients (A, B) per gain, sorted by period.
+		Between calibrated periods coefficients are interpolated linearly in log frequency,
+		outside of calibrated range the nearest calibrated period is used.
+	'''
+	def __init__(self, coef={}):
+		'''
+			coef - {gain: {period: (A, B)}}
+		'''
+		self.tables = {}
+		for gain in coef:
+			periods = sorted(coef[gain].keys())
+			self.setGain(gain, periods,
+				[coef[gain][p][0] for p in periods],
+				[coef[gain][p][1] for p in periods])
+		pass
+
+	def setGain(self, gain, periods, A, B):
+		'''
+			Coefficient arrays of one gain, periods sorted
+		'''
+		if len(periods)==0:
+			return
+		periods = np.asarray(periods)
+		self.tables[gain] = (periods.tolist(),
+			np.log(periods.astype(np.float64)),
+			np.asarray(A, dtype=np.complex128),
+			np.asarray(B, dtype=np.complex128))
+		pass
+
+	def coefficients(self, gain, period):
+		'''
+			return (A, B) for one point, None if gain is not calibrated
+		'''
+		if gain not in self.tables:
+			return None
+		(periods, x, tA, tB) = self.tables[gain]
+		i1 = bisect.bisect_left(periods, period)
+		if i1<len(periods) and periods[i1]==period:
+			return (complex(tA[i1]), complex(tB[i1]))
+		if i1==0:
+			return (complex(tA[0]), complex(tB[0]))
+		if i1==len(periods):
+			return (complex(tA[-1]), complex(tB[-1]))
+		i0 = i1-1
+		t = (math.log(period)-x[i0])/(x[i1]-x[i0])
+		return (complex((1-t)*tA[i0]+t*tA[i1]), complex((1-t)*tB[i0]+t*tB[i1]))
+
+	def lookup(self, period, gain_index):
+		'''
+			Vectorized coefficients.
+			return (found, A, B) arrays, found is False for not calibrated gains
+		'''
+		n = len(period)
+		found = np.zeros(n, dtype=bool)
+		A = np.zeros(n, dtype=np.complex128)
+		B = np.zeros(n, dtype=np.complex128)
+		for gain in np.unique(gain_index).tolist():
+			if gain not in self.tables:
+				continue
+			(periods, x, tA, tB) = self.tables[gain]
+			m = np.nonzero(gain_index==gain)[0]
+			xp = np.log(period[m].astype(np.float64))
+			if len(periods)==1:
+				i0 = np.zeros(len(m), dtype=np.int64)
+				i1 = i0
+				t = np.zeros(len(m))
+			else:
+				i1 = np.clip(np.searchsorted(x, xp), 1, len(periods)-1)
+				i0 = i1-1
+				t = np.clip((xp-x[i0])/(x[i1]-x[i0]), 0, 1)
+			found[m] = True
+			A[m] = (1-t)*tA[i0]+t*tA[i1]
+			B[m] = (1-t)*tB[i0]+t*tB[i1]
+		return (found, A, B)
+
+def correctAffine(table, R, period, gain_index):
+	'''
+		Zx = A*R+B, R is not changed for not calibrated gains
+	'''
+	(found, A, B) = table.lookup(period, gain_index)
+	return np.where(found, A*R+B, R)
+
+def correctOpen(table, R, period, gain_index):
+	'''
+		Zx = A/(1/R-B), R is not changed for not calibrated gains
+	'''
+	(found, A, B) = table.lookup(period, gain_index)
+	Zx = R.copy()
+	Zx[found] = A[found]/(1/R[found]-B[found])
+	return Zx
+
 class Corrector2x:
 	def __init__(self, diapazon):
 		self.load(diapazon)
@@ -173,55 +583,69 @@ class Corrector2x:
 			name0 = '10KOm'
 			name1 = '100KOm'
 
-		data = {}
+		columns = {}
 		for i in getGainCentralIdx():
 			prefix = 'cor/R'+str(diapazon)+'V0I'+str(i)+'_'
 			fname0 = prefix+name0+'.json'
 			fname1 = prefix+name1+'.json'
-			json_min = readJson(fname0)
-			json_max = readJson(fname1)
+			(json_min, cols_min) = readSweepColumns(sweepFile(fname0))
+			(json_max, cols_max) = readSweepColumns(sweepFile(fname1))
 
 			self.Rmin = json_min['R']
 			self.Rmax = json_max['R']
+			columns[i] = joinSweeps(cols_min, 'min', cols_max, 'max')
 
-			cur = {}
-			data[i] = cur
-			jfreq_min = json_min['freq']
-			for jf in jfreq_min:
-				res = calculateJson(jf)
-				cur[res['period']] = { 'min': res }
-
-			jfreq_max = json_max['freq']
-			for jf in jfreq_max:
-				res = calculateJson(jf)
-				cur[res['period']]['max'] = res
-
-		self.data = data
+		self.columns = columns
 		self.C = 1.2e-12
+		self.makeCoefficients()
+		pass
+
+	def makeCoefficients(self):
+		'''
+			Zx = A*Zxm+B
+		'''
+		Z1 = complex(self.Rmin, 0)
+		Z2 = complex(self.Rmax, 0)
+		self.table = CorrectionTable()
+		for gain_index_I, cur in self.columns.iteritems():
+			Zm1 = cur['min']
+			Zm2 = cur['max']
+			A = (Z2-Z1)/(Zm2-Zm1)
+			B = (Z1*Zm2-Z2*Zm1)/(Zm2-Zm1)
+			self.table.setGain(gain_index_I, cur['period'], A, B)
 		pass
 
 	def correct(self, R, period, F, attr):
 		gain_index_I = attr['gain_index_I']
-		if not (period in self.data[gain_index_I]):
+		coef = self.table.coefficients(gain_index_I, period)
+		if coef is None:
 			return R
 
-		d = self.data[gain_index_I][period]
-		Z1 = complex(self.Rmin, 0)
-		Z2 = complex(self.Rmax, 0)
-		Zm1 = d['min']['R']
-		Zm2 = d['max']['R']
-		A = (Z2-Z1)/(Zm2-Zm1)
-		B = (Z1*Zm2-Z2*Zm1)/(Zm2-Zm1)
+		(A, B) = coef
 		Zxm = R
 		Zx = A*Zxm+B
 		return Zx
 
+	def correctMany(self, R, period, gain_index):
+		return correctAffine(self.table, R, period, gain_index)
+
 class CorrectorOpen:
-	def __init__(self, diapazon):
-		self.load(diapazon)
+	def __init__(self, diapazon, compiled=None):
+		if compiled:
+			self.loadCompiled(diapazon, compiled)
+		else:
+			self.load(diapazon)
+		pass
+	def loadCompiled(self, diapazon, compiled):
+		self.columns = compiledColumns(compiled, CORRECTOR_OPEN, diapazon)
+		self.R = {}
+		for i in self.columns:
+			self.R[i] = float(compiled['open_R'][diapazon][i])
+		self.C = float(compiled['open_C'])
+		self.makeCoefficients()
 		pass
 	def load(self, diapazon):
-		data = {}
+		columns = {}
 		if diapazon==0:
 			name0 = ['100Om', '100Om', '1KOm']
 			rangeI = getGainCentralIdx()
@@ -242,49 +666,62 @@ class CorrectorOpen:
 			fname0 = prefix+name0[idx]+'.json'
 			fname1 = prefix+'open.json'
 
-			json_min = readJson(fname0)
-			json_max = readJson(fname1)
+			(json_min, cols_min) = readSweepColumns(sweepFile(fname0))
+			(json_max, cols_max) = readSweepColumns(sweepFile(fname1))
 
 			self.R[i] = json_min['R']
+			columns[i] = joinSweeps(cols_min, 'load', cols_max, 'open')
 
-			cur = {}
-			data[i] = cur
-			jfreq_min = json_min['freq']
-			for jf in jfreq_min:
-				res = calculateJson(jf)
-				cur[res['period']] = { 'load': res }
-
-			jfreq_max = json_max['freq']
-			for jf in jfreq_max:
-				res = calculateJson(jf)
-				cur[res['period']]['open'] = res
-
-		self.data = data
+		self.columns = columns
 		#self.C = 0.15e-12
 		self.C = 0.08e-12
+		self.makeCoefficients()
+		pass
+
+	def makeCoefficients(self):
+		'''
+			Zx = K/(1/Zxm-Yom)
+			K = Zstd*(1/Zstdm-1/Zom), Yom = 1/Zom
+		'''
+		self.table = CorrectionTable()
+		for gain_index_I, cur in self.columns.iteritems():
+			Zom = cur['open']
+			Zstdm = cur['load']
+			Ystd = 1.0/self.R[gain_index_I]+1j*(2*math.pi*self.C)*cur['F']
+			Zstd = 1/Ystd
+			#Zstd = complex(self.R, 0)
+			self.table.setGain(gain_index_I, cur['period'], Zstd*(1/Zstdm-1/Zom), 1/Zom)
 		pass
 
 	def correct(self, R, period, F, attr):
 		gain_index_I = attr['gain_index_I']
-		if not (period in self.data[gain_index_I]):
+		coef = self.table.coefficients(gain_index_I, period)
+		if coef is None:
 			return R
 
-		d = self.data[gain_index_I][period]
-		Zom = d['open']['R']
-		Zstdm = d['load']['R']
-		Ystd = complex(1.0/self.R[gain_index_I], 2*math.pi*F*self.C)
-		Zstd = 1/Ystd
-		#Zstd = complex(self.R, 0)
+		(K, Yom) = coef
 		Zxm = R
-		Zx = Zstd*(1/Zstdm-1/Zom)/(1/Zxm-1/Zom)
+		Zx = K/(1/Zxm-Yom)
 		return Zx
 
+	def correctMany(self, R, period, gain_index):
+		return correctOpen(self.table, R, period, gain_index)
+
 class CorrectorShort:
-	def __init__(self):
-		self.load()
+	def __init__(self, compiled=None):
+		if compiled:
+			self.loadCompiled(compiled)
+		else:
+			self.load()
+		pass
+	def loadCompiled(self, compiled):
+		self.columns = compiledColumns(compiled, CORRECTOR_SHORT, 0)
+		self.R1 = float(compiled['short_R1'])
+		self.R100 = float(compiled['short_R100'])
+		self.makeCoefficients()
 		pass
 	def load(self):
-		data = {}
+		columns = {}
 		for i in getGainOpenShortIdx():
 			prefix = 'cor/R0V'+str(i)+'I0_'
 			fname0 = prefix+'short.json'
@@ -292,50 +729,61 @@ class CorrectorShort:
 				fname1 = prefix+'1Om.json'
 			else:
 				fname1 = prefix+'100Om.json'
-			json_min = readJson(fname0)
-			json_max = readJson(fname1)
+			(json_min, cols_min) = readSweepColumns(sweepFile(fname0))
+			(json_max, cols_max) = readSweepColumns(sweepFile(fname1))
 
 			if i==7:
 				self.R1 = json_max['R']
 			else:
 				self.R100 = json_max['R']
+			columns[i] = joinSweeps(cols_min, 'short', cols_max, 'load')
 
-			cur = {}
-			data[i] = cur
-			jfreq_min = json_min['freq']
-			for jf in jfreq_min:
-				res = calculateJson(jf)
-				cur[res['period']] = { 'short': res }
-
-			jfreq_max = json_max['freq']
-			for jf in jfreq_max:
-				res = calculateJson(jf)
-				if res['period'] in cur:
-					cur[res['period']]['load'] = res
+		self.columns = columns
+		self.makeCoefficients()
+		pass
 
-		self.data = data
+	def makeCoefficients(self):
+		'''
+			Zx = A*(Zxm-Zsm) = A*Zxm+B
+			A = Zstd/(Zstdm-Zsm), B = -A*Zsm
+		'''
+		self.table = CorrectionTable()
+		for gain_index_V, cur in self.columns.iteritems():
+			if gain_index_V==7:
+				Zstd = complex(self.R1, 0)
+			else:
+				Zstd = complex(self.R100, 0)
+			Zsm = cur['short']
+			Zstdm = cur['load']
+			A = Zstd/(Zstdm-Zsm)
+			self.table.setGain(gain_index_V, cur['period'], A, -A*Zsm)
 		pass
 
 	def correct(self, R, period, F, attr):
 		gain_index_V = attr['gain_index_V']
-		if not (period in self.data[gain_index_V]):
+		coef = self.table.coefficients(gain_index_V, period)
+		if coef is None:
 			return R
-		d = self.data[gain_index_V][period]
-		Zsm = d['short']['R']
-		Zstdm = d['load']['R']
-		if gain_index_V==7:
-			Zstd = complex(self.R1, 0)
-		else:
-			Zstd = complex(self.R100, 0)
+		(A, B) = coef
 		Zxm = R
-		Zx = Zstd/(Zstdm-Zsm)*(Zxm-Zsm)
+		Zx = A*Zxm+B
 		return Zx
 
+	def correctMany(self, R, period, gain_index):
+		return correctAffine(self.table, R, period, gain_index)
+
 class Corrector:
 	def __init__(self):
 		self.load()
 		pass
 	def load(self):
+		sources = correctorSources()
+		compiled = readCompiledCorrector(CORRECTOR_CACHE, sources)
+		if compiled:
+			self.corr_short = CorrectorShort(compiled)
+			self.corr = [CorrectorOpen(diapazon, compiled) for diapazon in xrange(4)]
+			return
+
 		self.corr_short = CorrectorShort()
 		self.corr = []
 		#self.corr.append(Corrector2x(0))
@@ -344,6 +792,11 @@ class Corrector:
 		#self.corr.append(CorrectorOpen(3))
 		for diapazon in xrange(4):
 			self.corr.append(CorrectorOpen(diapazon))
+
+		try:
+			writeCompiledCorrector(CORRECTOR_CACHE, sources, self)
+		except (IOError, OSError) as e:
+			print "Cannot write", CORRECTOR_CACHE, e
 		pass
 	def correct(self, R, period, F, attr):
 		resistor_index = attr['resistor_index']
@@ -368,18 +821,42 @@ class Corrector:
 		res['Zx'] = Zx
 		return res
 
+	def correctMany(self, R, period, attr):
+		'''
+			Vectorized correct.
+			R, period - arrays, attr - dict of arrays resistor_index, gain_index_V, gain_index_I
+			return array of Zx
+		'''
+		R = np.asarray(R, dtype=np.complex128)
+		period = np.asarray(period)
+		resistor_index = np.asarray(attr['resistor_index'])
+		gain_index_V = np.asarray(attr['gain_index_V'])
+		gain_index_I = np.asarray(attr['gain_index_I'])
+
+		is_short = np.where(gain_index_V>0, True, np.where(gain_index_I>0, False, np.abs(R)<100))
+		Zx = R.copy()
+		Zx[is_short] = self.corr_short.correctMany(R[is_short], period[is_short], gain_index_V[is_short])
+		for diapazon in xrange(len(self.corr)):
+			m = np.logical_not(is_short) & (resistor_index==diapazon)
+			Zx[m] = self.corr[diapazon].correctMany(R[m], period[m], gain_index_I[m])
+		return Zx
+
+	def correctColumns(self, cols):
+		'''
+			Corrected Zx for every point of sweepColumns
+		'''
+		return self.correctMany(cols['R'], cols['period'], cols)
+
 class MaxAmplitude:
 	'''
 	Для резистора 100 КОм для оpen щупов ограничиваем амплитуду сигнала.
 	'''
 	def __init__(self):
-		json_open = readJson("cor/R3AUTO_open.json")
+		(json_open, cols) = readSweepColumns(sweepFile("cor/R3AUTO_open.json"))
 		data = {}
 
-		jfreq_open = json_open['freq']
-		for jf in jfreq_open:
-			attr = jf['attr']			
-			data[attr['period']] = { 'gain_index_I': attr['gain_index_I'] }
+		for (period, gain_index_I) in zip(cols['period'].tolist(), cols['gain_index_I'].tolist()):
+			data[period] = { 'gain_index_I': gain_index_I }
 
 		self.data = data
 		pass
@@ -429,7 +906,7 @@ def calculateLC(res, serial=True):
 
 
 def calculate(fileName):
-	jout = readJson(fileName)
+	jout = readCapture(fileName)
 	res = calculateJson(jout)
 
 	F = res['F']
@@ -459,7 +936,7 @@ def calculate(fileName):
 	return 'data' in jout
 
 def plotIVInternal(ax, fileName, average = False):
-	jout = readJson(fileName)
+	jout = readCapture(fileName)
 	jattr = jout["attr"]
 	ncycle = jattr['ncycle']
 
@@ -508,11 +985,8 @@ def plotRawInternal(ydata, ncycle, color, average, ax, dx, error, result):
 		csin = result["csin"]
 		ccos = result["ccos"]
 		c0 = result["c0"]
-		for i in xrange(len(timeList)):
-			fi = 2*math.pi*i/ncycle
-			v = math.sin(fi)*csin+math.cos(fi)*ccos+c0
-			ydata[i] -= v
-			#ydata[i] -= c0
+		(fsin, fcos) = smath.sinCosBasis(ncycle, len(timeList))
+		ydata = np.asarray(ydata, dtype=np.float64)-(fsin*csin+fcos*ccos+c0)
 
 	ax.plot (timeList, ydata, '-', color=color)
 	pass
@@ -520,7 +994,7 @@ def plotRawInternal(ydata, ncycle, color, average, ax, dx, error, result):
 def plotRaw(fileName, IV, average = False, error=False):
 
 	fig, ax = plt.subplots()
-	jout = readJson(fileName)
+	jout = readCapture(fileName)
 	jattr = jout["attr"]
 	ncycle = jattr['ncycle']
 
@@ -564,12 +1038,8 @@ def plotFftInternal(ydata, ncycle, color, average, ax, dx, result):
 	if average:
 		ydata = averagePeriod(ydata, ncycle)
 
-	csin = result["csin"]
-	ccos = result["ccos"]
 	c0 = result["c0"]
-	for i in xrange(len(ydata)):
-		fi = 2*math.pi*i/ncycle
-		ydata[i] -= c0
+	ydata = np.asarray(ydata, dtype=np.float64)-c0
 
 	#yfft = np.fft.fft(ydata)
 	yfft = fftNormalize(ydata)
@@ -587,7 +1057,7 @@ def plotFftInternal(ydata, ncycle, color, average, ax, dx, result):
 def plotFft(fileName, IV, average = False):
 
 	fig, ax = plt.subplots()
-	jout = readJson(fileName)
+	jout = readCapture(fileName)
 	jattr = jout["attr"]
 	ncycle = jattr['ncycle']
 
@@ -617,6 +1087,11 @@ def plotFft(fileName, IV, average = False):
 	plt.show()
 
 def main():
+	if len(sys.argv)>=3 and sys.argv[1]=='convert':
+		#jplot.py convert freq.json cor/*.json
+		convertSweeps(sys.argv[2:])
+		return
+
 	if len(sys.argv)>=2:
 		fileName = sys.argv[1]
 
@@ -87,7 +87,7 @@ class FormMain(QtGui.QMainWindow):
         pass
 
     def OnGraphOpen(self):
-        fileName = QtGui.QFileDialog.getOpenFileName(filter='freq json (*.json)', caption=TITLE+' - Open freq.json')
+        fileName = QtGui.QFileDialog.getOpenFileName(filter='freq (*.json *.npz)', caption=TITLE+' - Open freq.json')
         if len(fileName)==0:
             return
         form = plot.FormDrawData(TITLE, self)
@@ -193,6 +193,7 @@ class FormScan(QtGui.QMainWindow):
         s = self_ptr
         while s.scan_freq.next():
             if s.end_thread:
+                s.scan_freq.close()
                 return
             s.SetInfo()
             pass
@@ -224,13 +225,14 @@ class FormScan(QtGui.QMainWindow):
             s.scan_freq.init(resistorIndex=resistorData['resistorIndex'],
                             VIndex=VIndex, IIndex=IIndex,
                             amplitude=amplitude, fileName=fileName,
-                            maxAmplitude=s.maxAmplitude)
+                            maxAmplitude=s.maxAmplitude, resume=True)
 
             s.progress_bar.setRange(0, s.scan_freq.count())
             s.progress_bar.setValue(0)
 
             while s.scan_freq.next():
                 if s.end_thread:
+                    s.scan_freq.close()
                     return
                 s.SetInfo()
                 pass
@@ -250,9 +252,10 @@ class FormScan(QtGui.QMainWindow):
         data = jplot.calculateJson(jout)
         info = ''
         info += 'F=' + str(int(data['F']))
-        info += '\n' + 'R='+usb_commands.getResistorValueStr(usb_commands.resistorIdx)
-        info += '\n' + 'KU='+str(usb_commands.getGainValueV(usb_commands.gainVoltageIdx))+'x'
-        info += ' KI='+str(usb_commands.getGainValueI(usb_commands.gainCurrentIdx))+'x'
+        session = s.scan_freq.session
+        info += '\n' + 'R='+usb_commands.getResistorValueStr(session.resistorIdx)
+        info += '\n' + 'KU='+str(usb_commands.getGainValueV(session.gainVoltageIdx))+'x'
+        info += ' KI='+str(usb_commands.getGainValueI(session.gainCurrentIdx))+'x'
         info += '\n' + 'Rre='+str(jplot.formatR(data['R'].real))
         info += '\n' + 'Rim='+str(jplot.formatR(data['R'].imag))
 
@@ -0,0 +1,128 @@
+# coding=UTF-8
+# Frequency scan on all connected meters at the same time.
+import sys
+import time
+import threading
+import usb
+
+import usb_commands
+
+def findDevices():
+    '''
+    return list of all connected meters
+    '''
+    devs = usb.core.find(find_all=True,
+                         idVendor=usb_commands.USB_VENDOR_ID,
+                         idProduct=usb_commands.USB_PRODUCT_ID)
+    return list(devs)
+
+def deviceName(dev):
+    return '{:03d}-{:03d}'.format(dev.bus, dev.address)
+
+class MeterScan:
+    '''
+    ScanFreq on one meter, runs in own thread.
+    '''
+    def __init__(self, dev, fileName, scanArgs):
+        self.name = deviceName(dev)
+        self.fileName = fileName
+        self.scanArgs = scanArgs
+        self.session = usb_commands.MeterSession(dev)
+        self.scan_freq = usb_commands.ScanFreq(self.session)
+        self.error = None
+        self.complete = False
+        self.done = 0
+        self.total = len(usb_commands.periodAll())
+        self.th = threading.Thread(target=self.run, name=self.name)
+        self.th.daemon = True
+        pass
+
+    def current(self):
+        return self.done
+
+    def count(self):
+        return self.total
+
+    def run(self):
+        try:
+            self.session.dev.set_configuration()
+            self.scan_freq.init(fileName=self.fileName, **self.scanArgs)
+            self.total = self.scan_freq.count()
+            while self.scan_freq.next():
+                self.done = self.scan_freq.current()
+            self.done = self.scan_freq.current()
+            self.scan_freq.save()
+        except Exception as e:
+            self.error = e
+            self.scan_freq.close()
+        finally:
+            self.complete = True
+        pass
+
+class MultiScan:
+    '''
+    Run ScanFreq on every meter in parallel.
+    Result of every meter is written to fileNameFormat.format(name=deviceName).
+    Total time is the time of the slowest meter.
+    '''
+    def __init__(self, devs=None, fileNameFormat='freq_{name}.json', **scanArgs):
+        if devs is None:
+            devs = findDevices()
+        self.scans = [MeterScan(dev, fileNameFormat.format(name=deviceName(dev)), scanArgs) for dev in devs]
+        pass
+
+    def start(self):
+        for scan in self.scans:
+            scan.th.start()
+        pass
+
+    def complete(self):
+        return all(scan.complete for scan in self.scans)
+
+    def current(self):
+        return sum(scan.current() for scan in self.scans)
+
+    def count(self):
+        return sum(scan.count() for scan in self.scans)
+
+    def progressText(self):
+        txt = ''
+        for scan in self.scans:
+            txt += '{} {}/{} '.format(scan.name, scan.current(), scan.count())
+            if scan.error:
+                txt += 'error '
+        txt += 'total {}/{}'.format(self.current(), self.count())
+        return txt
+
+    def run(self, interval=0.5):
+        '''
+        Start all scans and print combined progress until all complete.
+        return {deviceName: fileName} for meters scanned without error.
+        '''
+        self.start()
+        while not self.complete():
+            print self.progressText()
+            time.sleep(interval)
+
+        for scan in self.scans:
+            scan.th.join()
+            if scan.error:
+                print scan.name, "error", scan.error
+        print self.progressText()
+
+        return dict((scan.name, scan.fileName) for scan in self.scans if not scan.error)
+
+def main():
+    multi = MultiScan()
+    if len(multi.scans)==0:
+        print 'Device not found'
+        return
+    start = time.time()
+    files = multi.run()
+    print "time=", time.time()-start
+    for name in sorted(files.keys()):
+        print name, files[name]
+    pass
+
+if __name__ == "__main__":
+    main()
@@ -8,11 +8,13 @@ import matplotlib
 import time
 import math
 import cmath
+import numpy as np
 from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt4agg import NavigationToolbar2QTAgg as NavigationToolbar
 from matplotlib.figure import Figure
 import jplot
 import usb_commands
+import usb_async
 
 
 class FormDrawData(QtGui.QMainWindow):
@@ -111,121 +113,68 @@ class FormDrawData(QtGui.QMainWindow):
 	def plotFreq(self, fileName):
 		gtype = self.gtype
 		ax = self.axes
-		jout = jplot.readJson(fileName)
-		jfreq = jout['freq']
-
-		f_data = []
-		re_data = []
-		im_data = []
-		dfi_data = []
-		re_error = []
-		im_error = []
-		re_corr = []
-		im_corr = []
-		arr_L = []
-		arr_C = []
-
-		amp_I = []
-		amp_V = []
-		fiV_data = []
-		fiI_data = []
-
 		if gtype=="ReImRaw":
 			corr = None
 		else:
 			corr = jplot.Corrector()
 
-		for jf in jfreq:
-			if corr:
-				res = corr.calculateJson(jf)
-				Zx = res['Zx']
-			else:
-				res = jplot.calculateJson(jf)
-				Zx = res['R']
-
-			#if res['period']<3*96:#quick fix
-			#	continue
-
-			F = res['F']
-			f_data.append(F)
-
-			#re_data.append(math.fabs(res['R'].real))
-			#im_data.append(abs(res['R']))
-			re_data.append(res['R'].real)
-			#im_data.append(math.fabs(res['R'].imag))
-			im_data.append(res['R'].imag)
-			re_error.append(jf['summary']['V']['square_error'])
-			im_error.append(jf['summary']['I']['square_error'])
-
-			gain_I = jf['attr']["gain_I"]
-			gain_V = jf['attr']["gain_V"]
-			#re_error.append(math.sqrt(jf['summary']['V']['sin']**2+jf['summary']['V']['cos']**2)/gain_V)
-			#im_error.append(math.sqrt(jf['summary']['I']['sin']**2+jf['summary']['I']['cos']**2)/gain_I)
-			#re_error.append(gain_V)
-			#im_error.append(gain_I)
-			#re_error.append(jf['attr']["gain_index_V"])
-			#im_error.append(jf['attr']["gain_index_I"])
-
-			#amp_I.append(abs(complex(jf['summary']['I']['sin']/gain_I, jf['summary']['I']['cos']/gain_I)))
-			#amp_V.append(abs(complex(jf['summary']['V']['sin']/gain_V, jf['summary']['V']['cos']/gain_V)))
-			amp_I.append(abs(complex(jf['summary']['I']['sin'], jf['summary']['I']['cos'])))
-			amp_V.append(abs(complex(jf['summary']['V']['sin'], jf['summary']['V']['cos'])))
-
-
-			if gtype=='dfic':
-				dfi_data.append(cmath.phase(Zx)*180/math.pi)
-			if gtype=='dfi':
-				dfi_data.append(cmath.phase(res['R'])*180/math.pi)
-				#dfi_data.append((cmath.phase(res['R'])-cmath.phase(Zx))*180/math.pi) #dfi error
-			
-			fiV_data.append(res['fiV'])
-			fiI_data.append(res['fiI'])
+		(jout, cols) = jplot.readSweepColumns(unicode(fileName))
+		R = cols['R']
+		if corr:
+			Zx = corr.correctColumns(cols)
+		else:
+			Zx = R
+
+		#if res['period']<3*96:#quick fix
+		#	continue
+
+		F = cols['F']
+		f_data = F
+
+		re_data = R.real
+		im_data = R.imag
+		re_error = cols['errorV']
+		im_error = cols['errorI']
 
+		#re_error = cols['gain_index_V']
+		#im_error = cols['gain_index_I']
+
+		#amp_I = np.abs(cols['zI'])
+		#amp_V = np.abs(cols['zV'])
+		amp_I = np.abs(cols['zI']*cols['gain_I']/jplot.toVolts)
+		amp_V = np.abs(cols['zV']*cols['gain_V']/jplot.toVolts)
+
+		if gtype=='dfic':
+			dfi_data = np.angle(Zx)*180/math.pi
+		if gtype=='dfi':
+			dfi_data = np.angle(R)*180/math.pi
+			#dfi_data = (np.angle(R)-np.angle(Zx))*180/math.pi #dfi error
+
+		with np.errstate(divide='ignore', invalid='ignore'):
 			if self.serial:
-				re_corr.append(Zx.real)
-				#im_corr.append(math.fabs(Zx.imag))
-				im_corr.append(Zx.imag)
-				
-				if Zx.imag>0:
-					L = Zx.imag/(2*math.pi*F)
-				else:
-					L = 0
+				re_corr = Zx.real
+				im_corr = Zx.imag
 
-				if Zx.imag<-1e-10:
-					C = -1/(2*math.pi*F*Zx.imag)
-					#C = min(C, 1e-6)
-				else:
-					C = 0
-				arr_L.append(L*1e6)
-				arr_C.append(C*1e12)
+				L = np.where(Zx.imag>0, Zx.imag/(2*math.pi*F), 0)
+				C = np.where(Zx.imag<-1e-10, -1/(2*math.pi*F*Zx.imag), 0)
+				#C = np.minimum(C, 1e-6)
+				arr_L = L*1e6
+				arr_C = C*1e12
 
 			if not self.serial: #parrallel
 				Yx = 1/Zx
 
 				im_max = 1e10
-				if Yx.real < 1/im_max:
-					re_corr.append(im_max)
-				else:
-					re_corr.append(1/Yx.real)
-
-				if math.fabs(Yx.imag)*im_max>1:
-					im_corr.append(1/Yx.imag)
-				else:
-					if Yx.imag>0:
-						im_corr.append(im_max)
-					else:
-						im_corr.append(-im_max)
+				re_corr = np.where(Yx.real<1/im_max, im_max, 1/Yx.real)
+				im_corr = np.where(np.fabs(Yx.imag)*im_max>1, 1/Yx.imag,
+					np.where(Yx.imag>0, im_max, -im_max))
 
 				C = Yx.imag/(2*math.pi*F)
-				C = min(C, 1e-6)
-				C = max(C, -1e-6)
-				arr_C.append(C*1e12)
+				C = np.clip(C, -1e-6, 1e-6)
+				arr_C = C*1e12
 
-				if Yx.imag<0:
-					L = -1/(2*math.pi*F*Yx.imag)
-				else:
-					L = 0
-				arr_L.append(L*1e6)
+				L = np.where(Yx.imag<0, -1/(2*math.pi*F*Yx.imag), 0)
+				arr_L = L*1e6
 
 
 
@@ -272,18 +221,22 @@ class FormDrawData(QtGui.QMainWindow):
 		pass
 
 class FormMeasure(QtGui.QMainWindow):
+	signalMeasured = QtCore.pyqtSignal(object)
+
 	def __init__(self, title, parent=None):
 		super(FormMeasure, self).__init__(parent)
 		self.setWindowTitle(title)
 		self.serial = True
-		self.end_thread = False
+		self.closed = False
 		self.createMainFrame()
 
 		self.corr = jplot.Corrector()
 		self.maxAmplitude = jplot.MaxAmplitude()
 
-		self.th = threading.Thread(target=self.UsbThread)
-		self.th.start()
+		#executor callbacks run on worker thread, widgets are updated on GUI thread
+		self.signalMeasured.connect(self.OnMeasured)
+		self.executor = usb_async.MeterExecutor()
+		self.requestMeasure()
 		pass
 
 	def createMainFrame(self):
@@ -347,23 +300,38 @@ class FormMeasure(QtGui.QMainWindow):
 
 	def closeEvent(self, event):
 		print "closeEvent"
-		self.end_thread = True
+		self.closed = True
+		self.executor.shutdown(wait=False)
 		event.accept()
 		pass
 
-	def UsbThread(self):
-		i = 0
-		while not self.end_thread:
-			jf = usb_commands.oneFreq(self.period, maxAmplitude=self.maxAmplitude)
-			if self.corr:
-				res = self.corr.calculateJson(jf)
-			else:
-				res = jplot.calculateJson(jf)
-				res['Zx'] = res['R']
-
-			if self.end_thread:
-				return
-			self.SetInfo(res)
+	def requestMeasure(self):
+		f = self.executor.oneFreq(self.period, maxAmplitude=self.maxAmplitude)
+		f.add_done_callback(self.signalMeasured.emit)
+		pass
+
+	def OnMeasured(self, f):
+		if self.closed:
+			return
+		error = f.exception()
+		if error is None:
+			try:
+				jf = f.result()
+				if self.corr:
+					res = self.corr.calculateJson(jf)
+				else:
+					res = jplot.calculateJson(jf)
+					res['Zx'] = res['R']
+				self.SetInfo(res)
+			except Exception as e:
+				error = e
+
+		if error is not None:
+			#measure stops, user sees why
+			print "measure error:", error
+			self.info_label.setText(u'Error: '+unicode(str(error), errors='replace'))
+			return
+		self.requestMeasure()
 		pass
 
 	def SetInfo(self, res):
@@ -0,0 +1,157 @@
+# coding=UTF-8
+# Archive of raw ADC captures.
+#   name.raw - blocks of capture header followed by V and I samples as packed uint16
+#   name.idx - capture headers with offsets, fixed size records
+# Readers get np.memmap views of samples, nothing is copied or parsed.
+#
+#   archive = RawArchive('lot42')
+#   archive.append(V, I, session.getAttr())
+#   (V, I) = archive.capture(0)
+import os
+import time
+import numpy as np
+
+VERSION = 1
+
+CAPTURE_DTYPE = np.dtype([
+    ('version', '<u2'),
+    ('gain_index_V', 'u1'),
+    ('gain_index_I', 'u1'),
+    ('resistor_index', 'u1'),
+    ('low_pass', 'u1'),
+    ('reserved', '<u2'),
+    ('offset', '<u8'), #offset of V samples in .raw file
+    ('size', '<u4'), #samples per channel
+    ('period', '<u4'),
+    ('clock', '<u4'),
+    ('ncycle', '<u4'),
+    ('timestamp', '<f8'),
+    ('gain_V', '<f8'),
+    ('gain_I', '<f8'),
+    ('resistor', '<f8'),
+])
+
+class RawArchive:
+    def __init__(self, name):
+        '''
+        name - file name without extension
+        '''
+        self.dataFileName = name+'.raw'
+        self.indexFileName = name+'.idx'
+        self.data = None
+        self.index = None
+        pass
+
+    def append(self, V, I, attr, timestamp=None):
+        '''
+        Append capture, attr like MeterSession.getAttr()
+        return index of capture
+        '''
+        V = np.asarray(V, dtype='<u2')
+        I = np.asarray(I, dtype='<u2')
+        if timestamp is None:
+            timestamp = time.time()
+
+        header = np.zeros(1, dtype=CAPTURE_DTYPE)
+        header['version'] = VERSION
+        for key in ('gain_index_V', 'gain_index_I', 'resistor_index', 'low_pass',
+                    'period', 'clock', 'ncycle', 'gain_V', 'gain_I', 'resistor'):
+            header[key] = attr[key]
+        header['size'] = len(V)
+        header['timestamp'] = timestamp
+
+        f = open(self.dataFileName, 'ab')
+        f.seek(0, os.SEEK_END)
+        header['offset'] = f.tell()+CAPTURE_DTYPE.itemsize
+        f.write(header.tostring())
+        f.write(V.tostring())
+        f.write(I.tostring())
+        f.close()
+
+        f = open(self.indexFileName, 'ab')
+        f.write(header.tostring())
+        f.close()
+        return self.count()-1
+
+    def refresh(self):
+        '''
+        Map files again if captures were appended.
+        '''
+        if not os.path.exists(self.indexFileName):
+            self.index = np.zeros(0, dtype=CAPTURE_DTYPE)
+            self.data = None
+            return
+        indexSize = os.path.getsize(self.indexFileName)//CAPTURE_DTYPE.itemsize
+        if self.index is None or len(self.index)!=indexSize:
+            self.index = np.memmap(self.indexFileName, dtype=CAPTURE_DTYPE, mode='r', shape=(indexSize,))
+            self.data = np.memmap(self.dataFileName, dtype=np.uint8, mode='r')
+        pass
+
+    def count(self):
+        self.refresh()
+        return len(self.index)
+
+    def header(self, i):
+        '''
+        return header record of capture i, fields of CAPTURE_DTYPE
+        '''
+        self.refresh()
+        return self.index[i]
+
+    def capture(self, i):
+        '''
+        return (V, I) uint16 memmap views
+        '''
+        self.refresh()
+        h = self.index[i]
+        offset = int(h['offset'])
+        nbytes = int(h['size'])*2
+        V = self.data[offset:offset+nbytes].view('<u2')
+        I = self.data[offset+nbytes:offset+2*nbytes].view('<u2')
+        return (V, I)
+
+    def attr(self, i):
+        '''
+        return attr dict like MeterSession.getAttr()
+        '''
+        h = self.header(i)
+        jattr = {}
+        for key in ('period', 'clock', 'ncycle', 'gain_index_V', 'gain_index_I',
+                    'resistor_index', 'low_pass'):
+            jattr[key] = int(h[key])
+        for key in ('gain_V', 'gain_I', 'resistor'):
+            jattr[key] = float(h[key])
+        return jattr
+
+    def captureJson(self, i):
+        '''
+        return out.json like dict, data are memmap views
+        '''
+        (V, I) = self.capture(i)
+        return { "attr": self.attr(i), "data": { "V": V, "I": I } }
+
+    def rebuildIndex(self):
+        '''
+        Write .idx again from headers in .raw, after crash between data and index write.
+        '''
+        headers = []
+        size = os.path.getsize(self.dataFileName)
+        f = open(self.dataFileName, 'rb')
+        pos = 0
+        while pos+CAPTURE_DTYPE.itemsize<=size:
+            f.seek(pos)
+            h = np.fromstring(f.read(CAPTURE_DTYPE.itemsize), dtype=CAPTURE_DTYPE)
+            end = int(h['offset'][0])+int(h['size'][0])*4
+            if end>size:
+                break
+            headers.append(h)
+            pos = end
+        f.close()
+
+        f = open(self.indexFileName, 'wb')
+        for h in headers:
+            f.write(h.tostring())
+        f.close()
+        self.index = None
+        self.refresh()
+        pass
@@ -0,0 +1,322 @@
+# coding=UTF-8
+# Software model of RLC meter for work without hardware.
+# SimulatedDevice replaces pyusb device in MeterSession:
+#   session = usb_commands.MeterSession(simulator.SimulatedDevice(impedance=complex(1000, -500)))
+import time
+import math
+import struct
+import array
+import usb
+import numpy as np
+
+import jplot
+import smath
+import usb_commands
+
+CLOCK = 72000000
+SINUS_BUFFER_SIZE = 2000
+MIN_SINUS_PERIOD = 192
+PACKET_SIZE = 32 #ADC buffer packet, see AdcUsbReadBuffer in adc.c
+
+ADC_MID = 3200 #middle of ADC good range
+ADC_AMPLITUDE = 200 #ADC amplitude for full DAC signal and gain 1x
+ADC_MAX = 4095
+
+def samplesPerPeriod(sinusPeriod):
+    '''
+    Same rounding as DacSetPeriod in dac.c
+    return (period, ncycle)
+    '''
+    period = 24
+    prescaler = 1
+    if sinusPeriod<MIN_SINUS_PERIOD:
+        sinusPeriod = MIN_SINUS_PERIOD
+    sinusPeriod = (sinusPeriod/(period*4))*period*4
+    ncycle = sinusPeriod/period
+    if ncycle>SINUS_BUFFER_SIZE:
+        prescaler = sinusPeriod/period/SINUS_BUFFER_SIZE
+        while SINUS_BUFFER_SIZE*prescaler*period<sinusPeriod:
+            prescaler += 1
+        p4 = period*prescaler*4
+        sinusPeriod = (sinusPeriod/p4)*p4
+        ncycle = sinusPeriod/period/prescaler
+    return (period*prescaler*ncycle, ncycle)
+
+class SimulatedDevice:
+    '''
+    Answers the same commands as firmware usb_commands.c with the same packed replies.
+    impedance - complex or function(F) returning complex, measured DUT.
+    noise - sigma of ADC noise in samples.
+    latency - seconds for every USB read.
+    '''
+    def __init__(self, impedance=complex(1000, 0), noise=2.0, latency=0.001, seed=None):
+        self.impedance = impedance
+        self.noise = noise
+        self.latency = latency
+        self.random = np.random.RandomState(seed)
+
+        self.replies = []
+        self.bufferData = None
+        self.bufferPos = 0
+
+        self.period = 0
+        self.ncycle = 0
+        self.amplitude = usb_commands.DEFAULT_DAC_AMPLITUDE
+        self.startTime = time.time()
+        self.readyTime = None
+        self.resistorIdx = 0
+        self.gainVoltageIdx = 0
+        self.gainCurrentIdx = 0
+        self.lowPass = 0
+        self.serial = 0
+        self.continuous = 0
+        self.summary = None
+        self.frameV = np.zeros(0, dtype=np.uint16)
+        self.frameI = np.zeros(0, dtype=np.uint16)
+        self.setPeriod(72000)
+        pass
+
+    def set_configuration(self):
+        pass
+
+    def reset(self):
+        pass
+
+    def __iter__(self):
+        return iter([])
+
+    def frameSize(self):
+        return (SINUS_BUFFER_SIZE/self.ncycle)*self.ncycle
+
+    def frameTime(self):
+        return self.frameSize()*self.period/float(self.ncycle*CLOCK)
+
+    def setPeriod(self, sinusPeriod):
+        (self.period, self.ncycle) = samplesPerPeriod(sinusPeriod)
+        self.startTime = time.time()
+        self.readyTime = None
+        pass
+
+    def getImpedance(self):
+        if callable(self.impedance):
+            return self.impedance(CLOCK/float(self.period))
+        return complex(self.impedance)
+
+    def phasors(self, resistorIdx, gainVoltageIdx, gainCurrentIdx):
+        '''
+        return complex amplitudes of V and I channels in ADC samples
+        '''
+        Z = self.getImpedance()
+        R = usb_commands.getResistorValue(resistorIdx)
+        k = ADC_AMPLITUDE*self.amplitude/float(usb_commands.DEFAULT_DAC_AMPLITUDE)
+        zV = k*usb_commands.getGainValuesX()[gainVoltageIdx]*Z/(R+Z)
+        zI = k*usb_commands.getGainValuesX()[gainCurrentIdx]*R/(R+Z)
+        return (zV, zI)
+
+    def sampleFrame(self, resistorIdx, gainVoltageIdx, gainCurrentIdx):
+        (zV, zI) = self.phasors(resistorIdx, gainVoltageIdx, gainCurrentIdx)
+        n = self.frameSize()
+        (s, c) = smath.sinCosBasis(self.ncycle, n)
+        v = ADC_MID+zV.real*s+zV.imag*c+self.random.normal(0, self.noise, n)
+        i = ADC_MID+zI.real*s+zI.imag*c+self.random.normal(0, self.noise, n)
+        v = np.clip(np.round(v), 0, ADC_MAX).astype(np.uint16)
+        i = np.clip(np.round(i), 0, ADC_MAX).astype(np.uint16)
+        return (v, i)
+
+    def computeChannel(self, data):
+        '''
+        Same result as AdcCalcData in calc.c
+        '''
+        n = len(data)
+        x = data.astype(np.float64)
+        mid = x.mean()
+        (s, c) = smath.sinCosBasis(self.ncycle, n)
+        k_sin = np.dot(x-mid, s)*2/n
+        k_cos = np.dot(x-mid, c)*2/n
+        d = mid+s*k_sin+c*k_cos-x
+        square_error = math.sqrt(np.dot(d, d)/(n-1))
+        return (int(data.min()), int(data.max()), k_sin, k_cos, mid, square_error)
+
+    def measure(self):
+        (self.frameV, self.frameI) = self.sampleFrame(self.resistorIdx, self.gainVoltageIdx, self.gainCurrentIdx)
+        self.summary = (self.computeChannel(self.frameV), self.computeChannel(self.frameI))
+        pass
+
+    def nextFrameTime(self, frames):
+        '''
+        Time when frames full ADC frames after current one are sampled.
+        '''
+        ft = self.frameTime()
+        now = time.time()
+        current = math.floor((now-self.startTime)/ft)
+        return self.startTime+(current+1+frames)*ft
+
+    def gainAuto(self):
+        '''
+        Predicted result of firmware auto range, without noise.
+        '''
+        goodMin = 2700
+        goodMax = 3700
+        for r in xrange(4):
+            (zV, zI) = self.phasors(r, 0, 0)
+            if abs(zI)*2*10>goodMax-goodMin:
+                break
+        self.resistorIdx = r
+
+        def good(z):
+            return ADC_MID-abs(z)>goodMin and ADC_MID+abs(z)<goodMax
+
+        self.gainVoltageIdx = 0
+        self.gainCurrentIdx = 0
+        for i in usb_commands.getGainCentralIdx():
+            (zV, zI) = self.phasors(r, i, i)
+            if good(zV):
+                self.gainVoltageIdx = i
+            if good(zI):
+                self.gainCurrentIdx = i
+        pass
+
+    def reply(self, data):
+        self.replies.append(array.array('B', data))
+
+    def command(self, cmd):
+        c = cmd[0]
+        out = struct.pack('=B', c)
+        if c==usb_commands.COMMAND_SET_LED:
+            out += struct.pack('=B', cmd[1])
+        elif c==usb_commands.COMMAND_SET_FREQUENCY:
+            F = struct.unpack_from('=I', cmd, 1)[0]
+            self.setPeriod(CLOCK/F)
+            out += struct.pack('=II', self.period, CLOCK)
+        elif c==usb_commands.COMMAND_SET_GAIN:
+            if cmd[1]:
+                self.gainVoltageIdx = cmd[2]
+            else:
+                self.gainCurrentIdx = cmd[2]
+        elif c==usb_commands.COMMAND_ADC_READ_BUFFER:
+            size = len(self.frameV)
+            out += struct.pack('=III', size, int(self.frameTime()*CLOCK), 0)
+            self.bufferData = self.frameV.tostring()+self.frameI.tostring()
+            self.bufferPos = 0
+        elif c==usb_commands.COMMAND_ADC_ELAPSED_TIME:
+            out += struct.pack('=I', int(self.frameTime()*CLOCK))
+        elif c==usb_commands.COMMAND_START_SYNCHRO:
+            (period, amplitude) = struct.unpack_from('=IH', cmd, 1)
+            self.amplitude = amplitude
+            self.setPeriod(period)
+            out += struct.pack('=III', self.period, CLOCK, self.ncycle)
+        elif c==usb_commands.COMMAND_SET_RESISTOR:
+            self.resistorIdx = cmd[1]
+            out += struct.pack('=B', cmd[1])
+        elif c==usb_commands.COMMAND_LAST_COMPUTE:
+            if self.summary is None:
+                self.measure()
+            (v, i) = self.summary
+            out += struct.pack('=HHHffffHHffffBI', self.frameSize(),
+                v[0], v[1], v[2], v[3], v[4], v[5],
+                i[0], i[1], i[2], i[3], i[4], i[5],
+                0, 0)
+        elif c==usb_commands.COMMAND_REQUEST_DATA:
+            self.readyTime = self.nextFrameTime(1)
+            self.measure()
+        elif c==usb_commands.COMMAND_DATA_COMPLETE:
+            complete = self.readyTime is not None and time.time()>=self.readyTime
+            out += struct.pack('=B', 1 if complete else 0)
+        elif c==usb_commands.COMMAND_SET_LOW_PASS:
+            self.lowPass = cmd[1]
+        elif c==usb_commands.COMMAND_START_GAIN_AUTO:
+            (count, predefinedResistorIdx) = struct.unpack_from('=BB', cmd, 1)
+            self.gainAuto()
+            if predefinedResistorIdx!=255:
+                self.resistorIdx = predefinedResistorIdx
+            self.readyTime = self.nextFrameTime(max(count, 1)+3)
+            self.measure()
+        elif c==usb_commands.COMMAND_RVI_INDEXES:
+            out += struct.pack('=BBB', self.resistorIdx, self.gainVoltageIdx, self.gainCurrentIdx)
+        elif c==usb_commands.COMMAND_SET_CORRECTOR2XR:
+            out += struct.pack('=B', cmd[1])
+        elif c==usb_commands.COMMAND_SET_CORRECTOR2X:
+            out += struct.pack('=BB', cmd[1], cmd[2])
+        elif c==usb_commands.COMMAND_SET_CORRECTOR_OPENR:
+            pass
+        elif c==usb_commands.COMMAND_SET_CORRECTOR_OPEN:
+            out += struct.pack('=B', cmd[1])
+        elif c==usb_commands.COMMAND_SET_CORRECTOR_SHORTR:
+            pass
+        elif c==usb_commands.COMMAND_SET_CORRECTOR_SHORT:
+            out += struct.pack('=B', cmd[1])
+        elif c==usb_commands.COMMAND_SET_CORRECTOR_PERIOD:
+            pass
+        elif c==usb_commands.COMMAND_CORRECTOR_FLASH_CLEAR:
+            out += struct.pack('=B', 1)
+        elif c==usb_commands.COMMAND_FLASH_CURRENT_DATA:
+            out += struct.pack('=B', 1)
+        elif c==usb_commands.COMMAND_SET_SERIAL:
+            self.serial = cmd[1]
+        elif c==usb_commands.COMMAND_SET_CONTINUOUS_MODE:
+            self.continuous = cmd[1]
+        self.reply(out)
+        pass
+
+    def write(self, endpoint, data, interface=0, timeout=None):
+        cmd = array.array('B', data)
+        if len(cmd)>0:
+            self.command(cmd)
+        return len(cmd)
+
+    def read(self, endpoint, size, interface=0, timeout=None):
+        if self.latency>0:
+            time.sleep(self.latency)
+        if self.replies:
+            return self.replies.pop(0)
+        if self.bufferData is not None and self.bufferPos<len(self.bufferData):
+            n = min(size, PACKET_SIZE)
+            data = self.bufferData[self.bufferPos:self.bufferPos+n]
+            self.bufferPos += n
+            return array.array('B', data)
+        raise usb.core.USBError('Operation timed out', errno=110)
+
+def benchmark(impedance=complex(1000, -1000), noise=2.0, latency=0.001):
+    '''
+    Sweep throughput on simulated device.
+    '''
+    session = usb_commands.MeterSession(SimulatedDevice(impedance=impedance, noise=noise, latency=latency, seed=1))
+    sc = usb_commands.ScanFreq(session)
+    start = time.time()
+    sc.init(fileName='freq_sim.json')
+    while sc.next():
+        pass
+    sweepTime = time.time()-start
+    sc.save()
+
+    print "points=", sc.count(), "time=", sweepTime, "per point=", sweepTime/sc.count()
+    for jf in sc.jfreq:
+        res = jplot.calculateJson(jf)
+        print "F=", res['F'], "R=", res['R']
+    return sweepTime
+
+def benchmarkGainSearch(impedances=[complex(10, -5), complex(1000, -1000), complex(30000, -100), complex(1e6, -1e6)],
+                        periods=usb_commands.HARDWARE_CORRECTOR_PERIODS, noise=2.0):
+    '''
+    Computes per setGainAuto of GAIN_SEARCH_LINEAR and GAIN_SEARCH_PREDICT, ranges should be the same.
+    '''
+    import usb_stats
+    for impedance in impedances:
+        for period in periods:
+            line = []
+            for search in (usb_commands.GAIN_SEARCH_LINEAR, usb_commands.GAIN_SEARCH_PREDICT):
+                session = usb_commands.MeterSession(SimulatedDevice(impedance=impedance, noise=noise, latency=0, seed=1))
+                session.adcSynchro(period)
+                session.stats = usb_stats.UsbStats()
+                session.setGainAuto(search=search)
+                computes = session.stats.calls['adcRequestLastCompute'].count
+                line += [search, computes, (session.resistorIdx, session.gainVoltageIdx, session.gainCurrentIdx)]
+            print "Z=", impedance, "period=", period, line
+    pass
+
+def main():
+    benchmark()
+    pass
+
+if __name__ == "__main__":
+    main()
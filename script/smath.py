@@ -1,5 +1,9 @@
 import math
 import array
+import time
+import threading
+import collections
+import numpy as np
 
 
 fileName = "out.dat"
@@ -10,7 +14,7 @@ def readFileAsShort(filename):
 		arr.fromstring(data)
 	return arr
 
-def calcSinCos(period, clock, ncycle, data):
+def calcSinCosLoop(period, clock, ncycle, data):
 	'''
 		return (c0,csin, ccos)
 		c0+csin*sin(f)+ccos*cos(f)
@@ -65,12 +69,12 @@ def calcFi(csin, ccos):
 	#print "fi=", fi
 	return (amplitude, fi)
 
-def deltaError(data, c0, amplitude, fi, ncycle):
+def deltaErrorLoop(data, c0, amplitude, fi, ncycle):
 	N = len(data)
 	out = [ c0+amplitude*math.sin(2*math.pi*i/ncycle+fi)-data[i] for i in xrange(N)]
 	return out
 
-def correctedSampleStandardDeviation(data, c0, amplitude, fi, ncycle):
+def correctedSampleStandardDeviationLoop(data, c0, amplitude, fi, ncycle):
 	N = len(data)
 	sum = 0
 	for i in xrange(N):
@@ -79,6 +83,104 @@ def correctedSampleStandardDeviation(data, c0, amplitude, fi, ncycle):
 
 	return math.sqrt(sum/(N-1))
 
+def calcAllLoop(period, clock, ncycle, data):
+	(c0, csin, ccos) = calcSinCosLoop(period, clock, ncycle, data)
+
+	(amplitude, fi) = calcFi(csin, ccos)
+	square_error = correctedSampleStandardDeviationLoop(data, c0, amplitude, fi, ncycle)
+	t_propagation = fi/(2*math.pi)*period/clock
+
+	print "square_error=", square_error
+
+	return {"period": period, "clock": clock, "ncycle": ncycle,
+		"c0": c0, "csin": csin, "ccos": ccos, "amplitude": amplitude,
+		"fi": fi, "square_error": square_error, "t_propagation": t_propagation}
+
+def sequentialSum(x):
+	'''
+		Sum in the same order as python loop, so results are identical to *Loop functions.
+	'''
+	if len(x)==0:
+		return 0
+	return float(np.cumsum(x)[-1])
+
+BASIS_CACHE_SIZE = 32 #(ncycle, N) pairs, a sweep uses only few of them
+basisCache = collections.OrderedDict()
+basisLock = threading.Lock()
+
+def cachedBasis(key, make):
+	'''
+		LRU cache of read-only numpy arrays, like g_sinusBufferFloat in calc.c
+	'''
+	with basisLock:
+		if key in basisCache:
+			value = basisCache.pop(key)
+			basisCache[key] = value
+			return value
+
+	value = make()
+	for arr in value:
+		arr.setflags(write=False)
+
+	with basisLock:
+		basisCache[key] = value
+		while len(basisCache)>BASIS_CACHE_SIZE:
+			basisCache.popitem(last=False)
+	return value
+
+def sinCosBasis(ncycle, N):
+	'''
+		return (sin(2*pi*i/ncycle), cos(2*pi*i/ncycle)) for i in 0..N-1
+		Arrays are shared and read-only.
+	'''
+	def make():
+		fi = 2*np.pi*np.arange(ncycle)/ncycle
+		reps = (N+ncycle-1)//ncycle
+		return (np.tile(np.sin(fi), reps)[:N], np.tile(np.cos(fi), reps)[:N])
+	return cachedBasis(('sincos', ncycle, N), make)
+
+def phaseBasis(ncycle, N):
+	'''
+		return 2*pi*i/ncycle for i in 0..N-1, shared and read-only.
+	'''
+	def make():
+		return (2*np.pi*np.arange(N)/ncycle,)
+	return cachedBasis(('phase', ncycle, N), make)[0]
+
+def calcSinCos(period, clock, ncycle, data):
+	'''
+		Same as calcSinCosLoop, vectorized.
+		return (c0,csin, ccos)
+		c0+csin*sin(f)+ccos*cos(f)
+	'''
+	arr = np.asarray(data, dtype=np.float32)
+	N = len(arr)
+
+	arr = arr.astype(np.float64)
+	c0 = sequentialSum(arr)/N
+	#like array('f'), centered samples are stored in float32
+	x = (arr-c0).astype(np.float32).astype(np.float64)
+
+	(fsin, fcos) = sinCosBasis(ncycle, N)
+	csin = float(sequentialSum(x*fsin)*2/N)
+	ccos = float(sequentialSum(x*fcos)*2/N)
+
+	print "csin=", csin
+	print "ccos=", ccos
+	return (c0, csin, ccos)
+
+def deltaError(data, c0, amplitude, fi, ncycle):
+	'''
+		Same as deltaErrorLoop, return numpy array.
+	'''
+	N = len(data)
+	return c0+amplitude*np.sin(phaseBasis(ncycle, N)+fi)-np.asarray(data, dtype=np.float64)
+
+def correctedSampleStandardDeviation(data, c0, amplitude, fi, ncycle):
+	N = len(data)
+	d = deltaError(data, c0, amplitude, fi, ncycle)
+	return math.sqrt(sequentialSum(d*d)/(N-1))
+
 def calcAll(period, clock, ncycle, data):
 	(c0, csin, ccos) = calcSinCos(period, clock, ncycle, data)
 
@@ -92,9 +194,181 @@ def calcAll(period, clock, ncycle, data):
 		"c0": c0, "csin": csin, "ccos": ccos, "amplitude": amplitude,
 		"fi": fi, "square_error": square_error, "t_propagation": t_propagation}
 
+def foldPeriod(data, ncycle):
+	'''
+		Average samples of all periods into one period.
+		return numpy array of ncycle samples
+	'''
+	x = np.asarray(data, dtype=np.float64)
+	num = len(x)//ncycle
+	if len(x)==num*ncycle:
+		return x.reshape(num, ncycle).mean(axis=0)
+	#partial last period is added but not counted, like old loop in jplot.averagePeriod
+	return np.bincount(np.arange(len(x))%ncycle, weights=x, minlength=ncycle)/num
+
+def stackCaptures(captures):
+	'''
+		captures - list of equal length sample arrays
+		return (mean, variance) per sample, variance is None for one capture
+	'''
+	stack = np.vstack([np.asarray(c, dtype=np.float64) for c in captures])
+	mean = stack.mean(axis=0)
+	if len(captures)<2:
+		return (mean, None)
+	return (mean, stack.var(axis=0, ddof=1))
+
+class SineFitAccumulator:
+	'''
+		Single pass version of calcAll for data arriving chunk by chunk.
+		Keeps running sums, so memory does not depend on capture length.
+		Result is equal to calcAll on concatenated chunks up to rounding.
+	'''
+	def __init__(self, ncycle, period=None, clock=None):
+		self.ncycle = ncycle
+		self.period = period
+		self.clock = clock
+		(self.fsin, self.fcos) = sinCosBasis(ncycle, ncycle)
+		#samples are accumulated relative to first one, that keeps sum_xx small
+		self.shift = None
+		self.n = 0
+		self.sum_x = 0.0
+		self.sum_xx = 0.0
+		self.sum_xsin = 0.0
+		self.sum_xcos = 0.0
+		self.sum_sin = 0.0
+		self.sum_cos = 0.0
+		self.sum_sin2 = 0.0
+		self.sum_cos2 = 0.0
+		self.sum_sincos = 0.0
+		pass
+
+	def add(self, data):
+		x = np.asarray(data, dtype=np.float64)
+		N = len(x)
+		if N==0:
+			return
+		if self.shift is None:
+			self.shift = x[0]
+		x = x-self.shift
+
+		idx = (self.n+np.arange(N))%self.ncycle
+		s = self.fsin[idx]
+		c = self.fcos[idx]
+
+		self.n += N
+		self.sum_x += x.sum()
+		self.sum_xx += np.dot(x, x)
+		self.sum_xsin += np.dot(x, s)
+		self.sum_xcos += np.dot(x, c)
+		self.sum_sin += s.sum()
+		self.sum_cos += c.sum()
+		self.sum_sin2 += np.dot(s, s)
+		self.sum_cos2 += np.dot(c, c)
+		self.sum_sincos += np.dot(s, c)
+		pass
+
+	def count(self):
+		return self.n
+
+	def result(self):
+		'''
+			return dict with the same keys as calcAll
+			raise ValueError if less than 2 samples were added
+		'''
+		N = self.n
+		if N<2:
+			raise ValueError('SineFitAccumulator needs at least 2 samples, has {}'.format(N))
+		m = self.sum_x/N
+		csin = (self.sum_xsin-m*self.sum_sin)*2/N
+		ccos = (self.sum_xcos-m*self.sum_cos)*2/N
+
+		#sum of (x-m-csin*sin-ccos*cos)^2 expanded over running sums
+		sum_d2 = (self.sum_xx-2*m*self.sum_x+N*m*m
+			-2*csin*(self.sum_xsin-m*self.sum_sin)
+			-2*ccos*(self.sum_xcos-m*self.sum_cos)
+			+csin*csin*self.sum_sin2+ccos*ccos*self.sum_cos2
+			+2*csin*ccos*self.sum_sincos)
+		square_error = math.sqrt(max(sum_d2, 0)/(N-1))
+
+		(amplitude, fi) = calcFi(csin, ccos)
+		if self.period is not None and self.clock is not None:
+			t_propagation = fi/(2*math.pi)*self.period/self.clock
+		else:
+			t_propagation = None
+
+		return {"period": self.period, "clock": self.clock, "ncycle": self.ncycle,
+			"c0": m+self.shift, "csin": csin, "ccos": ccos, "amplitude": amplitude,
+			"fi": fi, "square_error": square_error, "t_propagation": t_propagation}
+
+class PhasorRatioStats:
+	'''
+		Running mean, variance and covariance of V and I phasors (Welford),
+		relative standard error of Z=V/I from them.
+		Noise common to both channels cancels in Z, so covariance is kept.
+	'''
+	def __init__(self):
+		self.n = 0
+		self.meanV = 0j
+		self.meanI = 0j
+		self.m2V = 0.0
+		self.m2I = 0.0
+		self.cVI = 0j
+		pass
+
+	def add(self, zV, zI):
+		self.n += 1
+		dV = zV-self.meanV
+		dI = zI-self.meanI
+		self.meanV += dV/self.n
+		self.meanI += dI/self.n
+		self.m2V += (dV*(zV-self.meanV).conjugate()).real
+		self.m2I += (dI*(zI-self.meanI).conjugate()).real
+		self.cVI += dV*(zI-self.meanI).conjugate()
+		pass
+
+	def relativeError(self):
+		'''
+			return standard error of mean Z divided by abs(Z), inf if unknown
+		'''
+		n = self.n
+		if n<2 or self.meanV==0 or self.meanI==0:
+			return float('inf')
+		varV = self.m2V/(n-1)
+		varI = self.m2I/(n-1)
+		cov = self.cVI/(n-1)
+		#dZ/Z = dV/V-dI/I
+		rel2 = (varV/abs(self.meanV)**2+varI/abs(self.meanI)**2
+			-2*(cov/(self.meanV*self.meanI.conjugate())).real)/n
+		return math.sqrt(max(rel2, 0))
+
+def benchmark(ncycle=96, N=1920, repeat=20):
+	'''
+		Compare calcAll with calcAllLoop on synthetic ADC buffer.
+	'''
+	i = np.arange(N)
+	data = np.round(3200+200*np.sin(2*np.pi*i/ncycle+0.3)+np.random.normal(0, 2, N)).astype(np.uint16).tolist()
+	period = ncycle*24
+	clock = 72000000
+
+	start = time.time()
+	for r in xrange(repeat):
+		resLoop = calcAllLoop(period, clock, ncycle, data)
+	timeLoop = (time.time()-start)/repeat
+
+	start = time.time()
+	for r in xrange(repeat):
+		res = calcAll(period, clock, ncycle, data)
+	timeNp = (time.time()-start)/repeat
+
+	print "N=", N, "loop=", timeLoop, "numpy=", timeNp, "speedup=", timeLoop/timeNp
+	print "identical=", res==resLoop
+	pass
+
+
 
 
 def main():
+	benchmark()
 	pass
 
 if __name__ == "__main__":
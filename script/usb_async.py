@@ -0,0 +1,210 @@
+# coding=UTF-8
+# Non blocking front end for usb_commands.
+# Every blocking USB command of one MeterSession runs on a dedicated worker thread,
+# callers get Future objects and may wait for them or attach callbacks.
+#
+#   executor = MeterExecutor()
+#   f = executor.oneFreq(7200)
+#   f.add_done_callback(lambda f: show(f.result()))
+import sys
+import threading
+import traceback
+import Queue
+
+import usb_commands
+
+class Future:
+    '''
+    Result of command submitted to MeterExecutor.
+    '''
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.value = None
+        self.error = None
+        self.traceback = None #traceback of error on worker thread
+        self.running = False
+        self.cancelled = False
+        pass
+
+    def done(self):
+        return self.event.is_set()
+
+    def cancel(self):
+        '''
+        Cancel command that not started yet.
+        return True if cancelled
+        '''
+        with self.lock:
+            if self.running or self.done():
+                return False
+            self.cancelled = True
+        self.setResult(None)
+        return True
+
+    def result(self, timeout=None):
+        '''
+        Wait for command and return its result, exception of command is raised here.
+        '''
+        if not self.event.wait(timeout):
+            raise RuntimeError('Future timeout')
+        if self.error is not None:
+            #keep traceback of failing command, not of this line
+            raise type(self.error), self.error, self.traceback
+        return self.value
+
+    def exception(self, timeout=None):
+        if not self.event.wait(timeout):
+            raise RuntimeError('Future timeout')
+        return self.error
+
+    def add_done_callback(self, fn):
+        '''
+        fn(future) is called on worker thread when command complete,
+        or immediately if it is already complete.
+        '''
+        with self.lock:
+            if not self.done():
+                self.callbacks.append(fn)
+                return
+        fn(self)
+
+    def setResult(self, value, error=None, tb=None):
+        with self.lock:
+            self.value = value
+            self.error = error
+            self.traceback = tb
+            self.event.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                #error in callback must not stop executor thread
+                traceback.print_exc()
+        pass
+
+class MeterExecutor:
+    '''
+    Runs commands of one MeterSession on one dedicated thread in submit order.
+    '''
+    def __init__(self, session=None):
+        if session is None:
+            session = usb_commands.defaultSession
+        self.session = session
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        pass
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            (future, func, args, kwargs) = item
+            with future.lock:
+                if future.cancelled:
+                    continue
+                future.running = True
+            try:
+                value = func(*args, **kwargs)
+            except Exception as e:
+                future.setResult(None, e, sys.exc_info()[2])
+            else:
+                future.setResult(value)
+
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        self.queue.put((future, func, args, kwargs))
+        return future
+
+    def shutdown(self, wait=True):
+        '''
+        Stop worker after all submitted commands.
+        '''
+        self.queue.put(None)
+        if wait:
+            self.thread.join()
+        pass
+
+    def adcSynchro(self, inPeriod, inAmplitude=None):
+        return self.submit(self.session.adcSynchro, inPeriod, inAmplitude)
+
+    def setGainAuto(self, predefinedRes=-1, maxAmplitude=None, search=None):
+        return self.submit(self.session.setGainAuto, predefinedRes, maxAmplitude, search)
+
+    def adcRequestLastComputeX(self, count=10, tolerance=None, minCount=usb_commands.ADAPTIVE_MIN_COUNT, maxCount=None):
+        return self.submit(self.session.adcRequestLastComputeX, count, tolerance, minCount, maxCount)
+
+    def oneFreq(self, period, lowPass='auto', inAmplitude=None, maxAmplitude=None, count=None,
+                tolerance=None, minCount=usb_commands.ADAPTIVE_MIN_COUNT, maxCount=None):
+        return self.submit(self.session.oneFreq, period, lowPass, inAmplitude, maxAmplitude, count,
+                           tolerance, minCount, maxCount)
+
+    def scanFreq(self, onPoint=None, **initArgs):
+        '''
+        Start ScanFreq, every point is separate command,
+        so other commands submitted meanwhile run between points.
+        onPoint(scan_freq) is called after every point.
+        return Sweep
+        '''
+        return Sweep(self, onPoint, initArgs)
+
+class Sweep:
+    '''
+    ScanFreq running on MeterExecutor.
+    future gives ScanFreq after save, cancel() stops sweep after current point.
+    '''
+    def __init__(self, executor, onPoint, initArgs):
+        self.executor = executor
+        self.onPoint = onPoint
+        self.scan_freq = usb_commands.ScanFreq(executor.session)
+        self.future = Future()
+        self.cancelled = False
+        self.submit(self.scan_freq.init, **initArgs)
+        pass
+
+    def cancel(self):
+        self.cancelled = True
+        pass
+
+    def submit(self, func, *args, **kwargs):
+        f = self.executor.submit(func, *args, **kwargs)
+        f.add_done_callback(self.onStep)
+        pass
+
+    def onStep(self, f):
+        if f.error is not None:
+            self.scan_freq.close()
+            self.future.setResult(None, f.error, f.traceback)
+            return
+        #exception in callback is only printed by Future, sweep future must get it
+        try:
+            if f.value is not None and self.onPoint:
+                self.onPoint(self.scan_freq)
+
+            if self.cancelled:
+                self.scan_freq.close()
+                self.future.setResult(self.scan_freq)
+            elif f.value is None or f.value:
+                #after init or when more periods remain
+                self.submit(self.scan_freq.next)
+            else:
+                saved = self.executor.submit(self.scan_freq.save)
+                saved.add_done_callback(self.onSaved)
+        except Exception as e:
+            self.scan_freq.close()
+            self.future.setResult(None, e, sys.exc_info()[2])
+        pass
+
+    def onSaved(self, f):
+        if f.error is not None:
+            self.scan_freq.close()
+            self.future.setResult(None, f.error, f.traceback)
+        else:
+            self.future.setResult(self.scan_freq)
+        pass
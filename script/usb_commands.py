@@ -11,6 +11,10 @@ from jplot import calculateJson
 import jplot
 import json
 import smath
+import harmonics
+import threading
+import functools
+import numpy as np
 
 DEFAULT_DAC_AMPLITUDE = 1200
 #DEFAULT_DAC_AMPLITUDE = 800
@@ -39,21 +43,29 @@ COMMAND_FLASH_CURRENT_DATA = 22
 COMMAND_SET_SERIAL = 23
 COMMAND_SET_CONTINUOUS_MODE = 24
 
+USB_VENDOR_ID = 0x16C0
+USB_PRODUCT_ID = 0x05DC
+
 LOW_PASS_PERIOD = 24000 #3 KHz
 
-HARDWARE_CORRECTOR_PERIODS = [720000, 72000, 7200, 768, 384]
+RESULT_BUFFER_SIZE = 2000 #samples per channel, see RESULT_BUFFER_SIZE in adc.h
+COMPLETE_POLL_MIN = 0.001 #first poll interval after expected acquisition time
+COMPLETE_POLL_MAX = 0.01
+COMPLETE_TIMEOUT_MIN = 0.5
+SYNCHRO_SETTLE_FRAMES = 4 #ADC frames to wait after COMMAND_START_SYNCHRO
+SYNCHRO_SETTLE_MIN = 0.02
+ADAPTIVE_MIN_COUNT = 4 #default minCount of adaptive adcRequestLastComputeX
+ADAPTIVE_MAX_COUNT = 100 #default maxCount of adaptive adcRequestLastComputeX
 
+HARDWARE_CORRECTOR_PERIODS = [720000, 72000, 7200, 768, 384]
 
+GAIN_GOOD_MIN = 2700 #ADC min/max of well ranged signal, see setGainAuto
+GAIN_GOOD_MAX = 3700
+RANGE_HINT_MIN_SPAN = 0.5 #range hint is rejected if ADC span dropped below this part of hint span
+RANGE_HINTS_VERSION = 1
 
-dev = None
-gainVoltageIdx = 0
-gainCurrentIdx = 0
-resistorIdx = 0
-currentLowPass = 0
-ncycle = 0
-period = 0
-clock = 0
-amplitude = DEFAULT_DAC_AMPLITUDE
+GAIN_SEARCH_LINEAR = 'linear' #setGainAuto raises gain one step per compute
+GAIN_SEARCH_PREDICT = 'predict' #setGainAuto predicts gain from ADC span and confirms it
 
 def periodToFreqency(period):
     clock = 72000000
@@ -68,684 +80,1190 @@ def getGainCentralIdx():
 def getGainOpenShortIdx():
     return jplot.getGainOpenShortIdx() #[0,1,2,4,6,7]
 
-def inited():
-    return not (dev is None)
+def arrByteToShort(barray):
+    return np.asarray(barray, dtype=np.uint16).tolist()
 
-def findDevice():
-    global dev
-    dev = usb.core.find(idVendor=0x16C0, idProduct=0x05DC)
+def getGainValueV(idx):
+    mulPre = 3.74
+    mulX = getGainValuesX()[idx]
+    return mulPre*mulX
 
-    if dev is None:
-    	print 'Device not found'
-        return False
-    else:
-        print 'Device found'
+def getGainValueI(idx):
+    mulPre = 3.74
+    mulX = getGainValuesX()[idx]
+    return mulPre*mulX
 
-    dev.set_configuration()
-    return True
+def getResistorValues():
+    return [100, 1000, 10000, 100000]
 
-def dwrite(data):
-    return dev.write(1, data, interface=0)
-def dread():
-    d = dev.read(129, 128, interface=0, timeout=50)
-    return d
+def getResistorValue(idx):
+    r = getResistorValues()
+    return r[idx]
 
-def readAll():
-    time.sleep(0.1)
-    while True:
+def getResistorValueStr(idx):
+    r = ['100 Om', '1 KOm', '10 KOm', '100 KOm']
+    return r[idx]
+
+def getMinMax(arr):
+    xmin = arr[0]
+    xmax = arr[0]
+    for x in arr:
+        if x<xmin:
+            xmin = x
+        if x>xmax:
+            xmax = x
+    return (xmin, xmax)
+
+class RangeHints:
+    '''
+    Ranges (resistor, V gain, I gain) found by setGainAuto, keyed by period.
+    Nearly identical parts get the same ranges, so setGainAuto verifies hint
+    with one compute instead of full search.
+    Seeded from previous sweep (addSweep, loadSweep) or per lot profile (load, save).
+    '''
+    def __init__(self):
+        self.hints = {} #period -> [resistorIdx, idxV, idxI, spanV, spanI], span None if unknown
+        pass
+
+    def get(self, period):
+        return self.hints.get(period)
+
+    def range(self, period):
+        '''
+        return (resistorIdx, idxV, idxI) of period, None if there is no hint
+        '''
+        hint = self.hints.get(period)
+        if hint is None:
+            return None
+        return tuple(hint[:3])
+
+    def put(self, period, resistorIdx, idxV, idxI, spanV=None, spanI=None):
+        self.hints[period] = [resistorIdx, idxV, idxI, spanV, spanI]
+        pass
+
+    def remove(self, period):
+        self.hints.pop(period, None)
+        pass
+
+    def addPoint(self, jout):
+        '''
+        jout - adcLastCompute like dict, ADC spans are taken from summary
+        '''
+        jattr = jout['attr']
+        jV = jout['summary']['V']
+        jI = jout['summary']['I']
+        self.put(jattr['period'], jattr['resistor_index'], jattr['gain_index_V'], jattr['gain_index_I'],
+                 jV['max']-jV['min'], jI['max']-jI['min'])
+        pass
+
+    def addSweep(self, jfreq):
+        for jf in jfreq:
+            self.addPoint(jf)
+        pass
+
+    def loadSweep(self, fileName):
+        '''
+        Seed from freq.json like sweep (.json or .npz) measured with auto range.
+        '''
+        self.addSweep(jplot.readSweep(fileName)['freq'])
+        pass
+
+    def load(self, fileName):
+        f = open(fileName, 'r')
+        jout = json.load(f)
+        f.close()
+        if jout.get('version')!=RANGE_HINTS_VERSION:
+            raise ValueError('Bad range hints file '+fileName)
+        for jh in jout['hints']:
+            self.put(jh['period'], jh['resistor_index'], jh['gain_index_V'], jh['gain_index_I'],
+                     jh['span_V'], jh['span_I'])
+        pass
+
+    def save(self, fileName):
+        jhints = []
+        for period in sorted(self.hints):
+            (resistorIdx, idxV, idxI, spanV, spanI) = self.hints[period]
+            jhints.append({ "period": period, "resistor_index": resistorIdx,
+                            "gain_index_V": idxV, "gain_index_I": idxI,
+                            "span_V": spanV, "span_I": spanI })
+        f = open(fileName, 'w')
+        f.write(json.dumps({ "version": RANGE_HINTS_VERSION, "hints": jhints }, indent=1))
+        f.close()
+        pass
+
+def command(func):
+    '''
+    Serialize MeterSession method, only one command talks to device at a time.
+    '''
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            if self.stats is None:
+                return func(self, *args, **kwargs)
+            start = time.time()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                self.stats.addCall(func.__name__, time.time()-start)
+    return wrapper
+
+class MeterSession:
+    '''
+    One RLC meter: pyusb handle and current device state.
+    Commands are serialized, so session can be shared between threads.
+    '''
+    def __init__(self, dev=None):
+        self.dev = dev
+        self.lock = threading.RLock()
+        self.gainVoltageIdx = 0
+        self.gainCurrentIdx = 0
+        self.resistorIdx = 0
+        self.currentLowPass = 0
+        self.ncycle = 0
+        self.period = 0
+        self.clock = 0
+        self.amplitude = DEFAULT_DAC_AMPLITUDE
+        self.synchroPeriod = None #requested period of last adcSynchro, DAC is running on it
+        self.lastWaitTime = 0 #seconds spent in last waitComplete
+        self.stats = None #usb_stats.UsbStats, timing is collected if set
+        self.archive = None #raw_archive.RawArchive, adcSynchroJson appends captures if set
+        self.rangeHints = None #RangeHints, setGainAuto tries hint of period before full search
+        self.gainSearch = GAIN_SEARCH_LINEAR #default search of setGainAuto
+        self.harmonicCount = harmonics.DEFAULT_HARMONICS #harmonics analyzed on every adcRequestData, 0 - off
+        self.lastHarmonics = None #harmonics.analyzeCapture of last adcRequestData
+        pass
+
+    def sleep(self, seconds):
+        if self.stats is not None:
+            self.stats.addSleep(seconds)
+        time.sleep(seconds)
+
+    def inited(self):
+        return not (self.dev is None)
+
+    @command
+    def findDevice(self):
+        self.dev = usb.core.find(idVendor=USB_VENDOR_ID, idProduct=USB_PRODUCT_ID)
+
+        if self.dev is None:
+            print 'Device not found'
+            return False
+        else:
+            print 'Device found'
+
+        self.dev.set_configuration()
+        return True
+
+    @command
+    def initDevice(self):
+        if not (self.dev is None):
+            return True
+
+        if not self.findDevice():
+            return False
+        self.dev.reset()
+        for cfg in self.dev:
+            for i in cfg:
+                print "interface=", i.bInterfaceNumber
+                for e in i:
+                    print e.bEndpointAddress
+                    #printEndpoint(e)
+
+        #for x in xrange(4):
+        #    print "write=",dwrite([1])
+        #    readOne()
+        return True    
+
+    def dwrite(self, data):
+        with self.lock:
+            if self.stats is None:
+                return self.dev.write(1, data, interface=0)
+            start = time.time()
+            n = self.dev.write(1, data, interface=0)
+            self.stats.addCall('dwrite', time.time()-start, n)
+            return n
+
+    def dread(self, size=128):
+        with self.lock:
+            if self.stats is None:
+                return self.dev.read(129, size, interface=0, timeout=50)
+            start = time.time()
+            d = self.dev.read(129, size, interface=0, timeout=50)
+            self.stats.addCall('dread', time.time()-start, len(d))
+            return d
+
+    @command
+    def readAll(self):
+        self.sleep(0.1)
+        while True:
+            try:
+                data = self.dread()
+                if len(data)==0:
+                    break
+                print "readb=", data
+                print "read=", data.tostring()
+            except usb.core.USBError:
+                break
+        pass
+
+    @command
+    def readOne(self):
+        self.sleep(0.1)
         try:
-            data = dread()
+            data = self.dread()
             if len(data)==0:
-                break
-            print "readb=", data
-            print "read=", data.tostring()
+                print "Read empty"
+            else:
+                #print "readb=", data
+                #print "read=", data.tostring()
+                pass
         except usb.core.USBError:
-            break
-    pass
+            print "Read USB error"
+        pass
 
-def readOne():
-    time.sleep(0.1)
-    try:
-        data = dread()
-        if len(data)==0:
-            print "Read empty"
+    @command
+    def readInt(self):
+        data = self.dread()
+        if len(data)!=4:
+            print "Fail read int len="+str(len(data))
         else:
-            #print "readb=", data
-            #print "read=", data.tostring()
+            print data[0]+data[1]*0x100+data[2]*0x10000+data[3]*0x1000000
+
+    @command
+    def readCommand(self):
+        self.sleep(0.01)
+        try:
+            data = self.dread()
+            if len(data)==0:
+                print "Read empty"
+                return
+            else:
+                #print "readb=", data
+                pass
+        except usb.core.USBError:
+            print "Read USB error"
+            return
+
+        cmd = data[0]
+        if cmd==COMMAND_SET_LED:
+            print "Set led="+str(data[1]) 
+        elif cmd==COMMAND_SET_FREQUENCY:
+            self.period = struct.unpack_from('I', data, 1)[0]
+            self.clock = struct.unpack_from('I', data, 5)[0]
+            print "period=",self.period
+            print "clock=",self.clock
+            print "F=",self.clock/float(self.period)
+        elif cmd==COMMAND_SET_GAIN:
+            #print "set gain"
             pass
-    except usb.core.USBError:
-        print "Read USB error"
-    pass
+        elif cmd==COMMAND_ADC_ELAPSED_TIME:
+            print "Elapset ticks=", struct.unpack_from('I', data, 1)[0]
+        elif cmd==COMMAND_START_SYNCHRO:
+            (self.period, self.clock, self.ncycle) = struct.unpack_from('=III', data, 1)
+            print "period=",self.period
+            print "clock=",self.clock
+            print "F=",self.clock/float(self.period)
+            print "ncycle=", self.ncycle
+        elif cmd==COMMAND_SET_RESISTOR:
+            r = data[1]
+            if r==0:
+                print "r=100 Om"
+            elif r==1:
+                print "r=1 KOm"
+            elif r==2:
+                print "r=10 KOm"
+            elif r==3:
+                print "r=100 KOm"
+        elif cmd==COMMAND_LAST_COMPUTE:
+            pass
+        elif cmd==COMMAND_SET_LOW_PASS:
+            pass
+        elif cmd==COMMAND_START_GAIN_AUTO:
+            pass
+        else:
+            print "Unknown command="+str(data[0])
+        pass
 
-def readInt():
-    data = dread()
-    if len(data)!=4:
-        print "Fail read int len="+str(len(data))
-    else:
-        print data[0]+data[1]*0x100+data[2]*0x10000+data[3]*0x1000000
+    @command
+    def setFreq(self, F):
+        self.synchroPeriod = None
+        print "write=",self.dwrite(struct.pack("=BI", COMMAND_SET_FREQUENCY, F))
+        self.readCommand()
+        pass
 
-def readCommand():
-    global ncycle, period, clock
-    time.sleep(0.01)
-    try:
-        data = dread()
-        if len(data)==0:
-            print "Read empty"
-            return
+    @command
+    def setSetGain(self, isVoltage, gain):
+        if isVoltage!=0:
+            self.gainVoltageIdx = gain
         else:
-            #print "readb=", data
-            pass
-    except usb.core.USBError:
-        print "Read USB error"
-        return
+            self.gainCurrentIdx = gain
+        self.dwrite([ COMMAND_SET_GAIN, isVoltage, gain])
+        self.readCommand()
+        pass
 
-    cmd = data[0]
-    if cmd==COMMAND_SET_LED:
-        print "Set led="+str(data[1]) 
-    elif cmd==COMMAND_SET_FREQUENCY:
-        period = struct.unpack_from('I', data, 1)[0]
-        clock = struct.unpack_from('I', data, 5)[0]
-        print "period=",period
-        print "clock=",clock
-        print "F=",clock/float(period)
-    elif cmd==COMMAND_SET_GAIN:
-        #print "set gain"
-        pass
-    elif cmd==COMMAND_ADC_ELAPSED_TIME:
-        print "Elapset ticks=", struct.unpack_from('I', data, 1)[0]
-    elif cmd==COMMAND_START_SYNCHRO:
-        (period, clock, ncycle) = struct.unpack_from('=III', data, 1)
-        print "period=",period
-        print "clock=",clock
-        print "F=",clock/float(period)
-        print "ncycle=", ncycle
-    elif cmd==COMMAND_SET_RESISTOR:
-        r = data[1]
-        if r==0:
-            print "r=100 Om"
-        elif r==1:
-            print "r=1 KOm"
-        elif r==2:
-            print "r=10 KOm"
-        elif r==3:
-            print "r=100 KOm"
-    elif cmd==COMMAND_LAST_COMPUTE:
-        pass
-    elif cmd==COMMAND_SET_LOW_PASS:
-        pass
-    elif cmd==COMMAND_START_GAIN_AUTO:
+    @command
+    def startGainAuto(self, countComputeX, predefinedResistorIdx=255):
+        self.dwrite(struct.pack("=BBB", COMMAND_START_GAIN_AUTO, countComputeX, predefinedResistorIdx))
+        self.readCommand()
         pass
-    else:
-        print "Unknown command="+str(data[0])
-    pass
 
-def setFreq(F):
-    print "write=",dwrite(struct.pack("=BI", COMMAND_SET_FREQUENCY, F))
-    readCommand()
-    pass
+    @command
+    def setResistor(self, r):
+        self.resistorIdx = r
+        self.dwrite([COMMAND_SET_RESISTOR, r])
+        #readCommand()
+        data = self.dread()
+        assert(data[0]==COMMAND_SET_RESISTOR)
+
+    @command
+    def setLowPass(self, on):
+        if on:
+            r = 1
+        else:
+            r = 0        
+        self.currentLowPass = r
+        self.dwrite([COMMAND_SET_LOW_PASS, r])
+        data = self.dread()
+        assert(data[0]==COMMAND_SET_LOW_PASS)
+
+    @command
+    def adcElapsedTime(self):
+        self.dwrite([COMMAND_ADC_ELAPSED_TIME])
+        self.readCommand()
+        pass
 
-def setSetGain(isVoltage, gain):
-    global gainVoltageIdx, gainCurrentIdx
-    if isVoltage!=0:
-        gainVoltageIdx = gain
-    else:
-        gainCurrentIdx = gain
-    dwrite([ COMMAND_SET_GAIN, isVoltage, gain])
-    readCommand()
-    pass
+    @command
+    def adcReadRVI(self):
+        self.dwrite([COMMAND_RVI_INDEXES])
+        data = self.dread()
+        assert(data[0]==COMMAND_RVI_INDEXES)
+        (self.resistorIdx, self.gainVoltageIdx, self.gainCurrentIdx) = struct.unpack_from('=BBB', data, 1)
+        print "V="+str(self.gainVoltageIdx), "I="+str(self.gainCurrentIdx), "R="+str(self.resistorIdx)
+        pass
 
-def startGainAuto(countComputeX, predefinedResistorIdx=255):
-    dwrite(struct.pack("=BBB", COMMAND_START_GAIN_AUTO, countComputeX, predefinedResistorIdx))
-    readCommand()
-    pass
+    @command
+    def adcReadBuffer(self, fit=None):
+        '''
+        fit - optional (V, I) smath.SineFitAccumulator, fed by every packet as it arrives
+        return (V, I) uint16 numpy arrays,
+        both are views over one buffer filled directly by USB transfers
+        '''
+        self.dwrite([COMMAND_ADC_READ_BUFFER])
+        self.sleep(0.01)
+        data = self.dread()
+        (size, time72, g_adc_cycles) = struct.unpack_from('=III', data, 1)
+
+        #print "adcReadBuffer size=", size
+        #print "adcReadBuffer time=", time72
+        #print "g_adc_cycles=", g_adc_cycles
+
+        #size in 32 bit words, V samples first, I samples after
+        nbytes = size*4
+        result = bytearray(nbytes)
+        arr = np.frombuffer(result, dtype='<u2')
+        pos = 0
+        while pos<nbytes:
+            #request all remaining data, transfer ends on short packet
+            data = self.dread(nbytes-pos)
+            if len(data)==0:
+                break
+            result[pos:pos+len(data)] = data
+            if fit is not None:
+                self.fitPacket(fit, arr, size, pos/2, (pos+len(data))/2)
+            pos += len(data)
+
+        return (arr[:size], arr[size:])
+
+    def fitPacket(self, fit, arr, size, start, end):
+        '''
+        Route samples [start, end) of ADC buffer to V (first size samples) and I accumulators.
+        '''
+        if start<size:
+            fit[0].add(arr[start:min(end, size)])
+        if end>size:
+            fit[1].add(arr[max(start, size):end])
+        pass
 
+    @command
+    def adcReadBufferFit(self):
+        '''
+        Read ADC buffer and demodulate it while packets arrive.
+        return (V, I) dicts like smath.calcAll
+        '''
+        fit = (smath.SineFitAccumulator(self.ncycle, self.period, self.clock),
+               smath.SineFitAccumulator(self.ncycle, self.period, self.clock))
+        self.adcReadBuffer(fit)
+        return (fit[0].result(), fit[1].result())
+
+    @command
+    def adcSynchro(self, inPeriod, inAmplitude = None):
+        if inAmplitude!=None:
+            self.amplitude = inAmplitude
+        else:
+            self.amplitude = DEFAULT_DAC_AMPLITUDE
+        self.dwrite(struct.pack("=BIH", COMMAND_START_SYNCHRO, inPeriod, self.amplitude))
+        data = self.dread()
+        self.synchroPeriod = inPeriod
+        #print data
+        (self.period, self.clock, self.ncycle) = struct.unpack_from('=III', data, 1)
+        #print "period=",period, "freq=", clock/period, "ncycle=", ncycle
+        # " cycle_x4=", period/(24.0*4)
+        self.sleep(max(SYNCHRO_SETTLE_MIN, self.expectedCompleteTime(SYNCHRO_SETTLE_FRAMES)))
+
+    def frameSamples(self):
+        '''
+        Samples per channel in one ADC frame (AdcRoundSize in adc.c).
+        '''
+        if self.ncycle==0:
+            return RESULT_BUFFER_SIZE
+        return (RESULT_BUFFER_SIZE/self.ncycle)*self.ncycle
+
+    def frameTime(self):
+        '''
+        Duration of one ADC frame in seconds.
+        '''
+        if self.ncycle==0 or self.clock==0:
+            return 0.01
+        return self.frameSamples()*self.period/float(self.ncycle*self.clock)
+
+    def expectedCompleteTime(self, frames=1):
+        '''
+        Minimal time before firmware can have frames ADC frames computed.
+        '''
+        return frames*self.frameTime()
+
+    @command
+    def waitComplete(self, frames=1, timeout=None):
+        '''
+        Sleep once for expected acquisition time of frames ADC frames,
+        then poll COMMAND_DATA_COMPLETE with growing interval.
+        Time spent is stored in self.lastWaitTime and added to
+        self.stats as 'waitComplete' call if stats are collected.
+        return True if data complete
+        '''
+        expected = self.expectedCompleteTime(frames)
+        if timeout is None:
+            timeout = max(COMPLETE_TIMEOUT_MIN, expected*4)
+
+        start = time.time()
+        self.sleep(expected)
+        delay = COMPLETE_POLL_MIN
+        while True:
+            self.dwrite([COMMAND_DATA_COMPLETE]);
+            data = self.dread()
+            complete = struct.unpack_from('=B', data, 1)[0]
+            self.lastWaitTime = time.time()-start
+            if complete==1 or self.lastWaitTime>timeout:
+                break
+            self.sleep(delay)
+            delay = min(delay*2, COMPLETE_POLL_MAX)
+
+        if self.stats is not None:
+            self.stats.addCall('waitComplete', self.lastWaitTime)
+        if complete!=1:
+            print "complete error = ", complete
+        return complete==1
+
+    @command
+    def adcRequestData(self):
+        self.dwrite([COMMAND_REQUEST_DATA]);
+        self.dread()
+
+        self.waitComplete()
+
+        (out1, out2) = self.adcReadBuffer()
+        if self.harmonicCount>0:
+            self.lastHarmonics = harmonics.analyzeCapture(out1, out2, self.ncycle, self.harmonicCount)
+            if self.lastHarmonics['nonlinear']:
+                print "nonlinear DUT, THD I=", self.lastHarmonics['I']['thd']
+
+        return (out1, out2)
+
+    @command
+    def setCorrector2x(self, corrector, period):
+
+        for iresistor in xrange(3):
+            #iresistor == rezistorIdx
+            corr = corrector.corr[iresistor]
+            #Z1 = corr.Rmin
+            #Z2 = corr.Rmax
+            #dwrite(struct.pack("=BBBBff", COMMAND_SET_CORRECTOR2XR, iresistor,0,0,
+            #    Z1, Z2
+            #    ))
+            #data = dread()
+            #assert(data[0]==COMMAND_SET_CORRECTOR2XR)
+            #assert(data[1]==iresistor)
+
+            for gain_index_I in getGainCentralIdx():
+                Zstdm = jplot.calibrationR(corr.columns, gain_index_I, period, 'load')
+                Zom = jplot.calibrationR(corr.columns, gain_index_I, period, 'open')
+
+                self.dwrite(struct.pack("=BBBBffffff", COMMAND_SET_CORRECTOR2X, iresistor, gain_index_I, 0,
+                    Zstdm.real, Zstdm.imag,
+                    Zom.real, Zom.imag, 
+                    corr.R[gain_index_I], corr.C
+                    ))
+                data = self.dread()
+                assert(data[0]==COMMAND_SET_CORRECTOR2X)
+                assert(data[1]==iresistor)
+                assert(data[2]==gain_index_I)
+        pass
 
-def setResistor(r):
-    global resistorIdx
-    resistorIdx = r
-    dwrite([COMMAND_SET_RESISTOR, r])
-    #readCommand()
-    data = dread()
-    assert(data[0]==COMMAND_SET_RESISTOR)
+    @command
+    def setCorrectorOpen(self, corrector, period, maxAmplitude):
+        corr = corrector.corr[3]
+        amp = maxAmplitude.getMaxGainI(resistorIndex=3, period=period)
+        self.dwrite(struct.pack("=BBBBff", COMMAND_SET_CORRECTOR_OPENR, amp,0,0,
+            corr.R[0], corr.C
+            ))
+        data = self.dread()
+        assert(data[0]==COMMAND_SET_CORRECTOR_OPENR)
+
+        for gain_idx in xrange(len(getGainOpenShortIdx())):
+            gain_index_I = getGainOpenShortIdx()[gain_idx]
+            Zstdm = jplot.calibrationR(corr.columns, gain_index_I, period, 'load')
+            Zom = jplot.calibrationR(corr.columns, gain_index_I, period, 'open')
+            self.dwrite(struct.pack("=BBBBffff", COMMAND_SET_CORRECTOR_OPEN, gain_idx, 0, 0,
+                Zstdm.real, Zstdm.imag,
+                Zom.real, Zom.imag
+                ))
+            data = self.dread()
+            assert(data[0]==COMMAND_SET_CORRECTOR_OPEN)
+            assert(data[1]==gain_idx)
+        pass
 
-def setLowPass(on):
-    global currentLowPass
-    if on:
-        r = 1
-    else:
-        r = 0        
-    currentLowPass = r
-    dwrite([COMMAND_SET_LOW_PASS, r])
-    data = dread()
-    assert(data[0]==COMMAND_SET_LOW_PASS)
+    @command
+    def setCorrectorShort(self, corrector, period):
+        corr = corrector.corr_short
+        self.dwrite(struct.pack("=BBBBff", COMMAND_SET_CORRECTOR_SHORTR, 0,0,0,
+            corr.R100, corr.R1
+            ))
+        data = self.dread()
+        assert(data[0]==COMMAND_SET_CORRECTOR_SHORTR)
+
+        for gain_idx in xrange(len(getGainOpenShortIdx())):
+            gain_index_I = getGainOpenShortIdx()[gain_idx]
+            Zsm = jplot.calibrationR(corr.columns, gain_index_I, period, 'short')
+            Zstdm = jplot.calibrationR(corr.columns, gain_index_I, period, 'load')
+            self.dwrite(struct.pack("=BBBBffff", COMMAND_SET_CORRECTOR_SHORT, gain_idx, 0, 0,
+                Zsm.real, Zsm.imag,
+                Zstdm.real, Zstdm.imag
+                ))
+            data = self.dread()
+            assert(data[0]==COMMAND_SET_CORRECTOR_SHORT)
+            assert(data[1]==gain_idx)
+        pass
 
-def adcElapsedTime():
-    dwrite([COMMAND_ADC_ELAPSED_TIME])
-    readCommand()
-    pass
+    @command
+    def setCorrector(self, corrector, period, maxAmplitude):
+        self.setCorrector2x(corrector, period)
+        self.setCorrectorOpen(corrector, period, maxAmplitude)
+        self.setCorrectorShort(corrector, period)
 
-def adcReadRVI():
-    global gainVoltageIdx, gainCurrentIdx, resistorIdx
+        self.dwrite(struct.pack("=BBBBI", COMMAND_SET_CORRECTOR_PERIOD, 0,0,0, period))
+        data = self.dread()
+        assert(data[0]==COMMAND_SET_CORRECTOR_PERIOD)
+        pass
 
-    dwrite([COMMAND_RVI_INDEXES])
-    data = dread()
-    assert(data[0]==COMMAND_RVI_INDEXES)
-    (resistorIdx, gainVoltageIdx, gainCurrentIdx) = struct.unpack_from('=BBB', data, 1)
-    print "V="+str(gainVoltageIdx), "I="+str(gainCurrentIdx), "R="+str(resistorIdx)
-    pass
+    @command
+    def FlashCorrector(self, corrector, maxAmplitude):
+        self.dwrite([COMMAND_CORRECTOR_FLASH_CLEAR])
+        data = self.dread()
+        assert(data[0]==COMMAND_CORRECTOR_FLASH_CLEAR)
+        print "flash clear code=", data[1]
+
+        for period in HARDWARE_CORRECTOR_PERIODS:
+            self.setCorrector(corrector, period, maxAmplitude)
+            self.dwrite([COMMAND_FLASH_CURRENT_DATA])
+            data = self.dread()
+            assert(data[0]==COMMAND_FLASH_CURRENT_DATA)
+            print "flash write code=", data[1]
+        pass
 
-def adcReadBuffer():
-    dwrite([COMMAND_ADC_READ_BUFFER])
-    time.sleep(0.01)
-    data = dread()
-    (size, time72, g_adc_cycles) = struct.unpack_from('=III', data, 1)
-
-    #print "adcReadBuffer size=", size
-    #print "adcReadBuffer time=", time72
-    #print "g_adc_cycles=", g_adc_cycles
-
-    result = None
-    while size>0:
-        data = dread()
-        size -= len(data)/4
-        #print size, "d=", len(data)
-        #print data
-        if not result:
-            result = data
+    @command
+    def setSerial(self, ser=True):
+        if ser:
+            ser = 1
         else:
-            result += data
+            ser = 0
 
-    arr = array.array('H')
-    arr.fromstring(result)
+        self.dwrite([COMMAND_SET_SERIAL, ser])
+        data = self.dread()
+        assert(data[0]==COMMAND_SET_SERIAL)
 
-    arr1 = array.array('H')
-    arr2 = array.array('H')
-    size2 = len(arr)/2
-    for i in xrange(0, size2):
-        arr1.append(arr[i])
-        arr2.append(arr[i+size2])
+    @command
+    def setContinuousMode(self, m=True):
+        if m:
+            m = 1
+        else:
+            m = 0
+
+        self.dwrite([COMMAND_SET_CONTINUOUS_MODE, m])
+        data = self.dread()
+        assert(data[0]==COMMAND_SET_CONTINUOUS_MODE)
+
+    @command
+    def adcRequestLastCompute(self):
+        self.dwrite([COMMAND_REQUEST_DATA]);
+        self.dread()
+
+        self.waitComplete()
+        return self.adcLastCompute()
+
+    @command
+    def adcRequestLastComputeX(self, count=10, tolerance=None, minCount=ADAPTIVE_MIN_COUNT, maxCount=None):
+        '''
+        Average of count computes.
+        tolerance - adaptive mode, count is not used, computes are added until relative
+            standard error of Z=V/I is below tolerance, from minCount to maxCount
+            (max(minCount, ADAPTIVE_MAX_COUNT) if None) computes.
+            Number of averaged computes is stored in attr 'count',
+            reached relative error in attr 'z_error'.
+        '''
+        if tolerance is None:
+            maxCount = count
+        else:
+            if maxCount is None:
+                maxCount = max(minCount, ADAPTIVE_MAX_COUNT)
+            if maxCount<minCount:
+                raise ValueError('maxCount {} < minCount {}'.format(maxCount, minCount))
+        stats = smath.PhasorRatioStats()
+
+        data = self.adcRequestLastCompute()
+        dataI = data['summary']['I']
+        dataV = data['summary']['V']
+        stats.add(complex(dataV['sin'], dataV['cos']), complex(dataI['sin'], dataI['cos']))
+        n = 1
+        while n<maxCount:
+            if tolerance is not None and n>=minCount and stats.relativeError()<tolerance:
+                break
+            d = self.adcRequestLastCompute()
+            dV = d['summary']['V']
+            dI = d['summary']['I']
+            stats.add(complex(dV['sin'], dV['cos']), complex(dI['sin'], dI['cos']))
+            n += 1
+
+            dataV['sin'] += dV['sin']
+            dataV['cos'] += dV['cos']
+            dataV['square_error'] += dV['square_error']
+
+            dataI['sin'] += dI['sin']
+            dataI['cos'] += dI['cos']
+            dataI['square_error'] += dI['square_error']
+
+        dataV['sin'] /= n
+        dataV['cos'] /= n
+        dataV['square_error'] /= n
+
+        dataI['sin'] /= n
+        dataI['cos'] /= n
+        dataI['square_error'] /= n
+        if tolerance is not None:
+            data['attr']['count'] = n
+            data['attr']['z_error'] = stats.relativeError()
+        return data
+
+    @command
+    def adcRequestLastComputeHardAuto(self, countComputeX, predefinedResistorIdx=255):
+        self.startGainAuto(countComputeX, predefinedResistorIdx)
+
+        #init wait, resistor and gain frames are skipped by firmware before measure
+        frames = max(countComputeX, 1)+3
+        if self.waitComplete(frames, timeout=2+self.expectedCompleteTime(frames)*4):
+            print "complete ok"
+
+        self.adcReadRVI()    
+        return self.adcLastCompute()
+
+    @command
+    def setGainHint(self, predefinedRes=-1, maxAmplitude=None):
+        '''
+        Set range hint of current period and check it with one compute.
+        return True if ADC min/max are inside GAIN_GOOD_MIN..GAIN_GOOD_MAX and
+        ADC span is not much smaller than when hint was found
+        '''
+        if self.rangeHints is None:
+            return False
+        hint = self.rangeHints.get(self.period)
+        if hint is None:
+            return False
+        (resistorIdx, idxV, idxI, spanV, spanI) = hint
+        if predefinedRes>=0 and resistorIdx!=predefinedRes:
+            return False
+        if maxAmplitude and idxI>maxAmplitude.getMaxGainI(resistorIdx, self.period):
+            return False
+
+        self.setResistor(resistorIdx)
+        self.setSetGain(1, idxV)
+        self.setSetGain(0, idxI)
+        jout = self.adcRequestLastCompute()
+        jV = jout['summary']['V']
+        jI = jout['summary']['I']
+        for (jch, span) in ((jV, spanV), (jI, spanI)):
+            if jch['min']<=GAIN_GOOD_MIN or jch['max']>=GAIN_GOOD_MAX:
+                return False
+            #smaller signal, higher gain or resistor may be better
+            if span is not None and jch['max']-jch['min']<span*RANGE_HINT_MIN_SPAN:
+                return False
+
+        if spanV is None or spanI is None:
+            self.rangeHints.put(self.period, resistorIdx, idxV, idxI,
+                                jV['max']-jV['min'], jI['max']-jI['min'])
+        print "gain hint", " V="+str(idxV), "I="+str(idxI), "R="+str(resistorIdx)
+        return True
 
-    return (arr1, arr2)
+    def predictGainIdx(self, jch, gain, gainIdx, maxIdx=None):
+        '''
+        jch - summary of channel measured with gain index gain
+        return highest index of gainIdx where ADC min/max are expected inside
+            GAIN_GOOD_MIN..GAIN_GOOD_MAX, signal around mid scales with getGainValuesX() ratio
+        '''
+        gainValues = getGainValuesX()
+        mid = jch['mid']
+        best = gainIdx[0]
+        for i in gainIdx:
+            if maxIdx is not None and i>maxIdx:
+                break
+            k = float(gainValues[i])/gainValues[gain]
+            if mid+(jch['max']-mid)*k>=GAIN_GOOD_MAX or mid-(mid-jch['min'])*k<=GAIN_GOOD_MIN:
+                break
+            best = i
+        return best
+
+    @command
+    def setGainPredict(self, jout, gainIdx, stopV, stopI, maxGainI=None):
+        '''
+        Jump to predicted gains and confirm with compute, usually one or two computes.
+        Overloaded channel goes one step of gainIdx down and never returns above it.
+        jout - compute with current gains
+        '''
+        channels = []
+        if not stopV:
+            channels.append(['V', 1, None])
+        if not stopI:
+            channels.append(['I', 0, maxGainI])
+
+        for step in xrange(2*len(gainIdx)):
+            changed = False
+            for ch in channels:
+                (name, isVoltage, maxIdx) = ch
+                jch = jout['summary'][name]
+                gain = self.gainVoltageIdx if isVoltage else self.gainCurrentIdx
+                if jch['min']>GAIN_GOOD_MIN and jch['max']<GAIN_GOOD_MAX:
+                    target = self.predictGainIdx(jch, gain, gainIdx, maxIdx)
+                else:
+                    lower = [i for i in gainIdx if i<gain]
+                    target = lower[-1] if lower else gain
+                    ch[2] = target
+                if target!=gain:
+                    self.setSetGain(isVoltage, target)
+                    changed = True
+            if not changed:
+                break
+            jout = self.adcRequestLastCompute()
+        pass
 
-def arrByteToShort(barray):
-    sarray = array.array('H', barray)
-    return sarray.tolist()
+    @command
+    def setGainAuto(self, predefinedRes=-1, maxAmplitude=None, search=None):
+        '''
+        search - GAIN_SEARCH_LINEAR or GAIN_SEARCH_PREDICT, self.gainSearch if None
+        '''
+        if self.rangeHints is not None and self.setGainHint(predefinedRes, maxAmplitude):
+            return
+        if search is None:
+            search = self.gainSearch
 
-def getGainValueV(idx):
-    mulPre = 3.74
-    mulX = getGainValuesX()[idx]
-    return mulPre*mulX
+        idxV = 0
+        idxI = 0
 
-def getGainValueI(idx):
-    mulPre = 3.74
-    mulX = getGainValuesX()[idx]
-    return mulPre*mulX
+        goodMin = GAIN_GOOD_MIN
+        goodMax = GAIN_GOOD_MAX
+        #goodMin = 2300
+        #goodMax = 3850
 
-def getResistorValues():
-    return [100, 1000, 10000, 100000]
+        goodDelta = goodMax-goodMin
 
-def getResistorValue(idx):
-    r = getResistorValues()
-    return r[idx]
+        self.setSetGain(1, 0)
+        self.setSetGain(0, 0)
 
-def getResistorValueStr(idx):
-    r = ['100 Om', '1 KOm', '10 KOm', '100 KOm']
-    return r[idx]
+        resistorValues = getResistorValues()
 
-def adcSynchro(inPeriod, inAmplitude = None):
-    global ncycle, period, clock, amplitude
-    if inAmplitude!=None:
-        amplitude = inAmplitude
-    else:
-        amplitude = DEFAULT_DAC_AMPLITUDE
-    dwrite(struct.pack("=BIH", COMMAND_START_SYNCHRO, inPeriod, amplitude))
-    data = dread()
-    #print data
-    (period, clock, ncycle) = struct.unpack_from('=III', data, 1)
-    #print "period=",period, "freq=", clock/period, "ncycle=", ncycle
-    # " cycle_x4=", period/(24.0*4)
-    time.sleep(0.1)
+        if predefinedRes>=0:
+            self.setResistor(predefinedRes)
+        else:
+            #ищем резистор начиная с минимальных значений, ибо при перегрузе могут быть странные эффекты
+            for i in xrange(0, len(resistorValues)):
+                self.setResistor(i)
+                jout = self.adcRequestLastCompute()
+                jI = jout['summary']['I']
+                imin = jI['min']
+                imax = jI['max']
+                di = imax - imin
+                #print "gainR=", i
+                #print " imin="+str(imin)
+                #print " imax="+str(imax)
+
+                #прикидываем, что следующий диапазон уже плох
+                if di*10>goodDelta:
+                    break
+                pass
+
+        if predefinedRes==0:
+            jout = self.adcRequestLastCompute()
+
+        gainValues = getGainValuesX()
+        stopV = False
+        stopI = False
+
+        imax = None
+        if maxAmplitude:
+            imax = maxAmplitude.getMaxGainI(self.resistorIdx, self.period)
+        maxGainI = imax
+
+        if self.resistorIdx==0:
+            jV = jout['summary']['V']
+            vmin = jV['min']
+            vmax = jV['max']
+            jI = jout['summary']['I']
+            imin = jI['min']
+            imax = jI['max']
+            if (imax-imin) < (vmax-vmin):
+                stopV = True
+                gainIdx = getGainCentralIdx()
+                #print "getGainCentralIdx"
+            else:
+                stopI = True
+                gainIdx = getGainOpenShortIdx() #short calibration
+                #print "getGainOpenShortIdx"
 
-def adcRequestData():
-    dwrite([COMMAND_REQUEST_DATA]);
-    dread()
+        elif self.resistorIdx==3:
+            stopV = True
+            gainIdx = getGainOpenShortIdx() #open calibration
+        else:
+            stopV = True
+            gainIdx = getGainCentralIdx()
 
-    for i in xrange(0,50):
-        time.sleep(0.01)
-        dwrite([COMMAND_DATA_COMPLETE]);
-        data = dread()
-        complete = struct.unpack_from('=B', data, 1)[0]
-        if complete==1:
-            break
+        if search==GAIN_SEARCH_PREDICT:
+            if predefinedRes>0:
+                jout = self.adcRequestLastCompute()
+            self.setGainPredict(jout, gainIdx, stopV, stopI, maxGainI)
+            idxV = self.gainVoltageIdx
+            idxI = self.gainCurrentIdx
+        else:
+            #print gainIdx
+            for i in gainIdx:
+                #print i, stopV, stopI
+                if imax!=None and i>imax:
+                    stopI = True
+
+                if not stopV:
+                    self.setSetGain(1, i)
+                if not stopI:
+                    self.setSetGain(0, i)
+
+                jout = self.adcRequestLastCompute()
+                jV = jout['summary']['V']
+                vmin = jV['min']
+                vmax = jV['max']
+                jI = jout['summary']['I']
+                imin = jI['min']
+                imax = jI['max']
+                #print "gainI=", i
+                print " vmin="+str(vmin), " vmax="+str(vmax)
+                #print " imin="+str(imin)
+                #print " imax="+str(imax)
+                #print " DV="+str(vmax-vmin)
+                #print " DI="+str(imax-imin)
+
+                if not stopV and vmax<goodMax and vmin>goodMin:
+                    idxV = i
+                else:
+                    stopV = True
+
+                if not stopI and imax<goodMax and imin>goodMin:
+                    idxI = i
+                else:
+                    stopI = True
+                if stopI and stopV:
+                    break
+
+        self.setSetGain(1, idxV)
+        self.setSetGain(0, idxI)
+        if self.rangeHints is not None:
+            self.rangeHints.put(self.period, self.resistorIdx, idxV, idxI)
+        print "gain auto", " V="+str(idxV), "I="+str(idxI), "R="+str(self.resistorIdx)
+        pass
 
-    if complete!=1:
-        print "complete error = ", complete
+    @command
+    def adcLastCompute(self):
+        self.dwrite([COMMAND_LAST_COMPUTE])
+        data = self.dread()
+        (count, 
+         adc_min_v, adc_max_v, sin_v, cos_v, mid_v, square_error_v,
+         adc_min_i, adc_max_i, sin_i, cos_i, mid_i, square_error_i,
+         error, nop_number
+            )=struct.unpack_from('=HHHffffHHffffBI', data, 1)
+
+        if count==0:
+            count = 1
+        #print "nop_number=", nop_number, " error=", error
+        jout = {}
+        jdata = {}
+        jout["attr"] = self.getAttr()
+        jout["summary"] = jdata
+
+        jdata["V"] = {
+            "min": adc_min_v,
+            "max": adc_max_v,
+            "mid": mid_v,
+            "sin": sin_v,
+            "cos": cos_v,
+            "square_error": square_error_v,
+        }
+
+        jdata["I"] = {
+            "min": adc_min_i,
+            "max": adc_max_i,
+            "mid": mid_i,
+            "sin": sin_i,
+            "cos": cos_i,
+            "square_error": square_error_i,
+        }
+
+        #print jout
+        return jout
+
+    def getAttr(self):
+        jattr = {}
+        jattr["period"] = self.period
+        jattr["clock"] = self.clock
+        jattr["ncycle"] = self.ncycle
+        jattr["gain_index_V"] = self.gainVoltageIdx
+        jattr["gain_index_I"] = self.gainCurrentIdx
+        jattr["gain_V"] = getGainValueV(self.gainVoltageIdx)
+        jattr["gain_I"] = getGainValueI(self.gainCurrentIdx)
+        jattr["resistor_index"] = self.resistorIdx
+        jattr["resistor"] = getResistorValue(self.resistorIdx)
+        jattr["low_pass"] = self.currentLowPass
+        return jattr
+
+    @command
+    def adcSynchroJson(self, soft=True, corrector = None, count=10):
+        jdata = {}
+        jvariance = None
+
+        if count<2:
+            (out1, out2) = self.adcRequestData()
+            if self.archive is not None:
+                self.archive.append(out1, out2, self.getAttr())
+            jdata["V"] = arrByteToShort(out1)
+            jdata["I"] = arrByteToShort(out2)
+        else:
+            capturesV = []
+            capturesI = []
+            for i in xrange(count):
+                (out1, out2) = self.adcRequestData()
+                if self.archive is not None:
+                    self.archive.append(out1, out2, self.getAttr())
+                capturesV.append(out1)
+                capturesI.append(out2)
+            (meanV, varV) = smath.stackCaptures(capturesV)
+            (meanI, varI) = smath.stackCaptures(capturesI)
+            jdata["V"] = meanV.tolist()
+            jdata["I"] = meanI.tolist()
+            jvariance = { "V": varV.tolist(), "I": varI.tolist() }
+
+
+        jout = {}
+
+        jout["attr"] = self.getAttr()
+        jout["data"] = jdata
+        if jvariance:
+            jout["variance"] = jvariance
+        if jvariance:
+            #average of captures has less noise than last capture
+            jout["harmonics"] = harmonics.toJson(harmonics.analyzeJson(jout))
+        elif self.lastHarmonics is not None:
+            jout["harmonics"] = harmonics.toJson(self.lastHarmonics)
+
+
+        f = open('out.json', 'w')
+        f.write(json.dumps(jout))
+        f.close()
 
-    (out1, out2) = adcReadBuffer()
+        f = open('sout.json', 'w')
+        #jout = adcLastCompute()
+        if soft:
+            jout = self.adcRequestLastComputeX(count)
+        else:
+            jout = self.adcRequestLastComputeHardAuto(count)
+        f.write(json.dumps(jout))
+        f.close()
 
-    return (out1, out2)
+        if corrector:
+            data = corrector.calculateJson(jout)
+            R = data['Zx']
+        else:
+            data = calculateJson(jout)
+            R = data['R']
 
-def setCorrector2x(corrector, period):
+        print "Rre=", R.real
+        print "Rim=", R.imag
+        print "D={:3.3f} grad".format(cmath.phase(R)*180.0/math.pi)
+        print "ErrV=", jout['summary']['V']['square_error']
+        print "ErrI=", jout['summary']['I']['square_error']
 
-    for iresistor in xrange(3):
-        #iresistor == rezistorIdx
-        corr = corrector.corr[iresistor]
-        #Z1 = corr.Rmin
-        #Z2 = corr.Rmax
-        #dwrite(struct.pack("=BBBBff", COMMAND_SET_CORRECTOR2XR, iresistor,0,0,
-        #    Z1, Z2
-        #    ))
-        #data = dread()
-        #assert(data[0]==COMMAND_SET_CORRECTOR2XR)
-        #assert(data[1]==iresistor)
+        pass
 
-        for gain_index_I in getGainCentralIdx():
-            d = corr.data[gain_index_I][period]
-            Zstdm = d['load']['R']
-            Zom = d['open']['R']
+    @command
+    def oneFreq(self, period, lowPass='auto', inAmplitude = None, maxAmplitude=None, count=None,
+                tolerance=None, minCount=ADAPTIVE_MIN_COUNT, maxCount=None):
+        '''
+        tolerance - adaptive averaging from minCount to maxCount computes,
+            see adcRequestLastComputeX, count is not used then
+        '''
+        if lowPass=='auto':
+            lowPass = (period>=LOW_PASS_PERIOD)
+
+        print "period=", period
+        if count==None:
+            if period>=LOW_PASS_PERIOD:
+                count = 20
+            else:
+                count = 100
 
-            dwrite(struct.pack("=BBBBffffff", COMMAND_SET_CORRECTOR2X, iresistor, gain_index_I, 0,
-                Zstdm.real, Zstdm.imag,
-                Zom.real, Zom.imag, 
-                corr.R[gain_index_I], corr.C
-                ))
-            data = dread()
-            assert(data[0]==COMMAND_SET_CORRECTOR2X)
-            assert(data[1]==iresistor)
-            assert(data[2]==gain_index_I)
-    pass
+        self.adcSynchro(period, inAmplitude=inAmplitude)
+        self.setLowPass(lowPass)
+        self.setGainAuto(maxAmplitude=maxAmplitude)
+        self.sleep(0.01)
+        if tolerance is not None:
+            return self.adcRequestLastComputeX(tolerance=tolerance, minCount=minCount, maxCount=maxCount)
+        return self.adcRequestLastComputeX(count)
 
-def setCorrectorOpen(corrector, period, maxAmplitude):
-    corr = corrector.corr[3]
-    amp = maxAmplitude.getMaxGainI(resistorIndex=3, period=period)
-    dwrite(struct.pack("=BBBBff", COMMAND_SET_CORRECTOR_OPENR, amp,0,0,
-        corr.R[0], corr.C
-        ))
-    data = dread()
-    assert(data[0]==COMMAND_SET_CORRECTOR_OPENR)
-
-    for gain_idx in xrange(len(getGainOpenShortIdx())):
-        gain_index_I = getGainOpenShortIdx()[gain_idx]
-        d = corr.data[gain_index_I][period]
-        Zstdm = d['load']['R']
-        Zom = d['open']['R']
-        dwrite(struct.pack("=BBBBffff", COMMAND_SET_CORRECTOR_OPEN, gain_idx, 0, 0,
-            Zstdm.real, Zstdm.imag,
-            Zom.real, Zom.imag
-            ))
-        data = dread()
-        assert(data[0]==COMMAND_SET_CORRECTOR_OPEN)
-        assert(data[1]==gain_idx)
-    pass
+#Session used by module level functions, single meter scripts and GUI
+defaultSession = MeterSession()
 
-def setCorrectorShort(corrector, period):
-    corr = corrector.corr_short
-    dwrite(struct.pack("=BBBBff", COMMAND_SET_CORRECTOR_SHORTR, 0,0,0,
-        corr.R100, corr.R1
-        ))
-    data = dread()
-    assert(data[0]==COMMAND_SET_CORRECTOR_SHORTR)
-
-    for gain_idx in xrange(len(getGainOpenShortIdx())):
-        gain_index_I = getGainOpenShortIdx()[gain_idx]
-        d = corr.data[gain_index_I][period]
-        Zsm = d['short']['R']
-        Zstdm = d['load']['R']
-        dwrite(struct.pack("=BBBBffff", COMMAND_SET_CORRECTOR_SHORT, gain_idx, 0, 0,
-            Zsm.real, Zsm.imag,
-            Zstdm.real, Zstdm.imag
-            ))
-        data = dread()
-        assert(data[0]==COMMAND_SET_CORRECTOR_SHORT)
-        assert(data[1]==gain_idx)
-    pass
+def inited():
+    return defaultSession.inited()
 
-def setCorrector(corrector, period, maxAmplitude):
-    setCorrector2x(corrector, period)
-    setCorrectorOpen(corrector, period, maxAmplitude)
-    setCorrectorShort(corrector, period)
+def findDevice():
+    return defaultSession.findDevice()
 
-    dwrite(struct.pack("=BBBBI", COMMAND_SET_CORRECTOR_PERIOD, 0,0,0, period))
-    data = dread()
-    assert(data[0]==COMMAND_SET_CORRECTOR_PERIOD)
-    pass
+def initDevice():
+    return defaultSession.initDevice()
 
-def FlashCorrector(corrector, maxAmplitude):
-    dwrite([COMMAND_CORRECTOR_FLASH_CLEAR])
-    data = dread()
-    assert(data[0]==COMMAND_CORRECTOR_FLASH_CLEAR)
-    print "flash clear code=", data[1]
-
-    for period in HARDWARE_CORRECTOR_PERIODS:
-        setCorrector(corrector, period, maxAmplitude)
-        dwrite([COMMAND_FLASH_CURRENT_DATA])
-        data = dread()
-        assert(data[0]==COMMAND_FLASH_CURRENT_DATA)
-        print "flash write code=", data[1]
-    pass
+def dwrite(data):
+    return defaultSession.dwrite(data)
 
-def setSerial(ser=True):
-    if ser:
-        ser = 1
-    else:
-        ser = 0
+def dread(size=128):
+    return defaultSession.dread(size)
 
-    dwrite([COMMAND_SET_SERIAL, ser])
-    data = dread()
-    assert(data[0]==COMMAND_SET_SERIAL)
-    
-def setContinuousMode(m=True):
-    if m:
-        m = 1
-    else:
-        m = 0
+def readAll():
+    return defaultSession.readAll()
 
-    dwrite([COMMAND_SET_CONTINUOUS_MODE, m])
-    data = dread()
-    assert(data[0]==COMMAND_SET_CONTINUOUS_MODE)
+def readOne():
+    return defaultSession.readOne()
 
+def readInt():
+    return defaultSession.readInt()
 
-def adcRequestLastCompute():
-    dwrite([COMMAND_REQUEST_DATA]);
-    dread()
-
-    for i in xrange(0,20):
-        time.sleep(0.01)
-        dwrite([COMMAND_DATA_COMPLETE]);
-        data = dread()
-        complete = struct.unpack_from('=B', data, 1)[0]
-        if complete==1:
-            break
-
-    if complete!=1:
-        print "complete error = ", complete
-    #else:
-        #print "complete ok"
-    return adcLastCompute()
-
-def adcRequestLastComputeX(count=10):
-    data = adcRequestLastCompute()
-    dataI = data['summary']['I']
-    dataV = data['summary']['V']
-    for i in xrange(1, count):
-        d = adcRequestLastCompute()
-        dV = d['summary']['V']
-        dI = d['summary']['I']
-
-        dataV['sin'] += dV['sin']
-        dataV['cos'] += dV['cos']
-        dataV['square_error'] += dV['square_error']
-        
-        dataI['sin'] += dI['sin']
-        dataI['cos'] += dI['cos']
-        dataI['square_error'] += dI['square_error']
-
-    dataV['sin'] /= count
-    dataV['cos'] /= count
-    dataV['square_error'] /= count
-
-    dataI['sin'] /= count
-    dataI['cos'] /= count
-    dataI['square_error'] /= count
-    return data
+def readCommand():
+    return defaultSession.readCommand()
 
-def adcRequestLastComputeHardAuto(countComputeX, predefinedResistorIdx=255):
-    startGainAuto(countComputeX, predefinedResistorIdx)
+def setFreq(F):
+    return defaultSession.setFreq(F)
 
-    for i in xrange(0,20):
-        time.sleep(0.1)
-        dwrite([COMMAND_DATA_COMPLETE]);
-        data = dread()
-        complete = struct.unpack_from('=B', data, 1)[0]
-        if complete==1:
-            break
-
-    if complete!=1:
-        print "complete error = ", complete
-    else:
-        print "complete ok"
+def setSetGain(isVoltage, gain):
+    return defaultSession.setSetGain(isVoltage, gain)
 
-    adcReadRVI()    
-    return adcLastCompute()
+def startGainAuto(countComputeX, predefinedResistorIdx=255):
+    return defaultSession.startGainAuto(countComputeX, predefinedResistorIdx)
 
+def setResistor(r):
+    return defaultSession.setResistor(r)
 
-def getMinMax(arr):
-    xmin = arr[0]
-    xmax = arr[0]
-    for x in arr:
-        if x<xmin:
-            xmin = x
-        if x>xmax:
-            xmax = x
-    return (xmin, xmax)
+def setLowPass(on):
+    return defaultSession.setLowPass(on)
 
+def adcElapsedTime():
+    return defaultSession.adcElapsedTime()
 
-def setGainAuto(predefinedRes=-1, maxAmplitude=None):
-    idxV = 0
-    idxI = 0
+def adcReadRVI():
+    return defaultSession.adcReadRVI()
 
-    goodMin = 2700
-    goodMax = 3700
-    #goodMin = 2300
-    #goodMax = 3850
+def adcReadBuffer():
+    return defaultSession.adcReadBuffer()
 
-    goodDelta = goodMax-goodMin
+def adcReadBufferFit():
+    return defaultSession.adcReadBufferFit()
 
-    setSetGain(1, 0)
-    setSetGain(0, 0)
+def adcSynchro(inPeriod, inAmplitude = None):
+    return defaultSession.adcSynchro(inPeriod, inAmplitude)
 
-    resistorValues = getResistorValues()
+def frameSamples():
+    return defaultSession.frameSamples()
 
-    if predefinedRes>=0:
-        setResistor(predefinedRes)
-    else:
-        #ищем резистор начиная с минимальных значений, ибо при перегрузе могут быть странные эффекты
-        for i in xrange(0, len(resistorValues)):
-            setResistor(i)
-            jout = adcRequestLastCompute()
-            jI = jout['summary']['I']
-            imin = jI['min']
-            imax = jI['max']
-            di = imax - imin
-            #print "gainR=", i
-            #print " imin="+str(imin)
-            #print " imax="+str(imax)
+def frameTime():
+    return defaultSession.frameTime()
 
-            #прикидываем, что следующий диапазон уже плох
-            if di*10>goodDelta:
-                break
-            pass
+def expectedCompleteTime(frames=1):
+    return defaultSession.expectedCompleteTime(frames)
 
-    if predefinedRes==0:
-        jout = adcRequestLastCompute()
+def waitComplete(frames=1, timeout=None):
+    return defaultSession.waitComplete(frames, timeout)
 
-    gainValues = getGainValuesX()
-    stopV = False
-    stopI = False
+def adcRequestData():
+    return defaultSession.adcRequestData()
 
-    imax = None
-    if maxAmplitude:
-        imax = maxAmplitude.getMaxGainI(resistorIdx, period)
+def setCorrector2x(corrector, period):
+    return defaultSession.setCorrector2x(corrector, period)
 
-    if resistorIdx==0:
-        jV = jout['summary']['V']
-        vmin = jV['min']
-        vmax = jV['max']
-        jI = jout['summary']['I']
-        imin = jI['min']
-        imax = jI['max']
-        if (imax-imin) < (vmax-vmin):
-            stopV = True
-            gainIdx = getGainCentralIdx()
-            #print "getGainCentralIdx"
-        else:
-            stopI = True
-            gainIdx = getGainOpenShortIdx() #short calibration
-            #print "getGainOpenShortIdx"
+def setCorrectorOpen(corrector, period, maxAmplitude):
+    return defaultSession.setCorrectorOpen(corrector, period, maxAmplitude)
 
-    elif resistorIdx==3:
-        stopV = True
-        gainIdx = getGainOpenShortIdx() #open calibration
-    else:
-        stopV = True
-        gainIdx = getGainCentralIdx()
+def setCorrectorShort(corrector, period):
+    return defaultSession.setCorrectorShort(corrector, period)
 
-    #print gainIdx
-    for i in gainIdx:
-        #print i, stopV, stopI
-        if imax!=None and i>imax:
-            stopI = True
+def setCorrector(corrector, period, maxAmplitude):
+    return defaultSession.setCorrector(corrector, period, maxAmplitude)
 
-        if not stopV:
-            setSetGain(1, i)
-        if not stopI:
-            setSetGain(0, i)
+def FlashCorrector(corrector, maxAmplitude):
+    return defaultSession.FlashCorrector(corrector, maxAmplitude)
 
-        jout = adcRequestLastCompute()
-        jV = jout['summary']['V']
-        vmin = jV['min']
-        vmax = jV['max']
-        jI = jout['summary']['I']
-        imin = jI['min']
-        imax = jI['max']
-        #print "gainI=", i
-        print " vmin="+str(vmin), " vmax="+str(vmax)
-        #print " imin="+str(imin)
-        #print " imax="+str(imax)
-        #print " DV="+str(vmax-vmin)
-        #print " DI="+str(imax-imin)
-
-        if not stopV and vmax<goodMax and vmin>goodMin:
-            idxV = i
-        else:
-            stopV = True
+def setSerial(ser=True):
+    return defaultSession.setSerial(ser)
 
-        if not stopI and imax<goodMax and imin>goodMin:
-            idxI = i
-        else:
-            stopI = True
-        if stopI and stopV:
-            break
+def setContinuousMode(m=True):
+    return defaultSession.setContinuousMode(m)
 
-    setSetGain(1, idxV)
-    setSetGain(0, idxI)
-    print "gain auto", " V="+str(idxV), "I="+str(idxI), "R="+str(resistorIdx)
-    pass
+def adcRequestLastCompute():
+    return defaultSession.adcRequestLastCompute()
 
-def adcLastCompute():
-    dwrite([COMMAND_LAST_COMPUTE])
-    data = dread()
-    (count, 
-     adc_min_v, adc_max_v, sin_v, cos_v, mid_v, square_error_v,
-     adc_min_i, adc_max_i, sin_i, cos_i, mid_i, square_error_i,
-     error, nop_number
-        )=struct.unpack_from('=HHHffffHHffffBI', data, 1)
-
-    if count==0:
-        count = 1
-    #print "nop_number=", nop_number, " error=", error
-    jout = {}
-    jdata = {}
-    jout["attr"] = getAttr()
-    jout["summary"] = jdata
-
-    jdata["V"] = {
-        "min": adc_min_v,
-        "max": adc_max_v,
-        "mid": mid_v,
-        "sin": sin_v,
-        "cos": cos_v,
-        "square_error": square_error_v,
-    }
-
-    jdata["I"] = {
-        "min": adc_min_i,
-        "max": adc_max_i,
-        "mid": mid_i,
-        "sin": sin_i,
-        "cos": cos_i,
-        "square_error": square_error_i,
-    }
-
-    #print jout
-    return jout
+def adcRequestLastComputeX(count=10, tolerance=None, minCount=ADAPTIVE_MIN_COUNT, maxCount=None):
+    return defaultSession.adcRequestLastComputeX(count, tolerance, minCount, maxCount)
 
-def getAttr():
-    jattr = {}
-    jattr["period"] = period
-    jattr["clock"] = clock
-    jattr["ncycle"] = ncycle
-    jattr["gain_index_V"] = gainVoltageIdx
-    jattr["gain_index_I"] = gainCurrentIdx
-    jattr["gain_V"] = getGainValueV(gainVoltageIdx)
-    jattr["gain_I"] = getGainValueI(gainCurrentIdx)
-    jattr["resistor_index"] = resistorIdx
-    jattr["resistor"] = getResistorValue(resistorIdx)
-    jattr["low_pass"] = currentLowPass
-    return jattr
+def adcRequestLastComputeHardAuto(countComputeX, predefinedResistorIdx=255):
+    return defaultSession.adcRequestLastComputeHardAuto(countComputeX, predefinedResistorIdx)
 
-def adcSynchroJson(soft=True, corrector = None, count=10):
-    jdata = {}
+def setGainHint(predefinedRes=-1, maxAmplitude=None):
+    return defaultSession.setGainHint(predefinedRes, maxAmplitude)
 
-    if count<2:
-        (out1, out2) = adcRequestData()
-        jdata["V"] = arrByteToShort(out1)
-        jdata["I"] = arrByteToShort(out2)
-    else:
-        (out1x, out2x) = adcRequestData()
-        out1xh = arrByteToShort(out1x)
-        out2xh = arrByteToShort(out2x)
-        out1 = [ float(out1xh[i]) for i in xrange(len(out1xh))]
-        out2 = [ float(out2xh[i]) for i in xrange(len(out2xh))]
-        for i in xrange(1, count):
-            (out1x, out2x) = adcRequestData()
-            out1xh = arrByteToShort(out1x)
-            out2xh = arrByteToShort(out2x)
-            for j in xrange(len(out1)):
-                out1[j] += out1xh[j]
-                out2[j] += out2xh[j]
-
-        for j in xrange(len(out1)):
-            out1[j] /= float(count)
-            out2[j] /= float(count)
-        jdata["V"] = out1
-        jdata["I"] = out2
-
-
-    jout = {}
-
-    jout["attr"] = getAttr()
-    jout["data"] = jdata
-
-
-    f = open('out.json', 'w')
-    f.write(json.dumps(jout))
-    f.close()
-    
-    f = open('sout.json', 'w')
-    #jout = adcLastCompute()
-    if soft:
-        jout = adcRequestLastComputeX(count)
-    else:
-        jout = adcRequestLastComputeHardAuto(count)
-    f.write(json.dumps(jout))
-    f.close()
+def setGainAuto(predefinedRes=-1, maxAmplitude=None, search=None):
+    return defaultSession.setGainAuto(predefinedRes, maxAmplitude, search)
 
-    if corrector:
-        data = corrector.calculateJson(jout)
-        R = data['Zx']
-    else:
-        data = calculateJson(jout)
-        R = data['R']
+def adcLastCompute():
+    return defaultSession.adcLastCompute()
 
-    print "Rre=", R.real
-    print "Rim=", R.imag
-    print "D={:3.3f} grad".format(cmath.phase(R)*180.0/math.pi)
-    print "ErrV=", jout['summary']['V']['square_error']
-    print "ErrI=", jout['summary']['I']['square_error']
+def getAttr():
+    return defaultSession.getAttr()
 
-    pass
+def adcSynchroJson(soft=True, corrector = None, count=10):
+    return defaultSession.adcSynchroJson(soft, corrector, count)
 
+def oneFreq(period, lowPass='auto', inAmplitude = None, maxAmplitude=None, count=None,
+            tolerance=None, minCount=ADAPTIVE_MIN_COUNT, maxCount=None):
+    return defaultSession.oneFreq(period, lowPass, inAmplitude, maxAmplitude, count,
+                                  tolerance, minCount, maxCount)
 
 def period10Hz_100Hz():
     arr = []
@@ -783,7 +1301,6 @@ def period10Khz_100KHz():
         arr.append(period)
     return arr
 
-
 def period90Khz_max():
     arr = []
     for period in xrange(10*96, 2*96, -96):
@@ -794,43 +1311,205 @@ def periodAll():
     #return period100Hz_1KHz()+period1KHz_10KHz()+period10Khz_max()
     return HARDWARE_CORRECTOR_PERIODS
 
-def allFreq(amplitude=DEFAULT_DAC_AMPLITUDE, resistorIndex=None, VIndex=None, IIndex=None, fileName='freq.json'):
-    sc = ScanFreq()
+def allFreq(amplitude=DEFAULT_DAC_AMPLITUDE, resistorIndex=None, VIndex=None, IIndex=None, fileName='freq.json', session=None):
+    sc = ScanFreq(session)
     sc.init(amplitude=amplitude, resistorIndex=resistorIndex, VIndex=VIndex, IIndex=IIndex, fileName=fileName)
     while sc.next():
-        print "f=", periodToFreqency(period), "p=", period
+        print "f=", periodToFreqency(sc.session.period), "p=", sc.session.period
         pass
-    print "f=", periodToFreqency(period), "p=", period
+    print "f=", periodToFreqency(sc.session.period), "p=", sc.session.period
     sc.save()
     pass
 
-def oneFreq(period, lowPass='auto', inAmplitude = None, maxAmplitude=None, count=None):
-    if lowPass=='auto':
-        lowPass = (period>=LOW_PASS_PERIOD)
+def planSweep(periods, lowPass=0, rangeOf=None):
+    '''
+    Measurement order of sweep periods.
+    Low pass switch settles 1 s and relay switches settle too, so periods are
+    grouped by low pass state, group of current lowPass state goes first.
+    Inside group periods of the same range are measured together,
+    rangeOf(period) - (resistor, V gain, I gain), None if unknown (auto gain).
+    Otherwise order is monotonic, neighbour periods likely get the same auto range
+    and both groups meet at LOW_PASS_PERIOD.
+    return list of periods
+    '''
+    lowPass = bool(lowPass)
+    periods = set(periods)
+    first = sorted([p for p in periods if (p>=LOW_PASS_PERIOD)==lowPass], reverse=lowPass)
+    second = sorted([p for p in periods if (p>=LOW_PASS_PERIOD)!=lowPass], reverse=lowPass)
+    if rangeOf is None:
+        return first+second
+
+    plan = []
+    for group in (first, second):
+        ranges = []
+        for p in group:
+            r = rangeOf(p)
+            if r not in ranges:
+                ranges.append(r)
+        #continue with range of last measured period
+        if plan and rangeOf(plan[-1]) in ranges:
+            ranges.remove(rangeOf(plan[-1]))
+            ranges.insert(0, rangeOf(plan[-1]))
+        plan += sorted(group, key=lambda p: ranges.index(rangeOf(p)))
+    return plan
+
+SWEEP_SYNC_POINTS = 10 #fsync sweep journal after this number of points
+SWEEP_SYNC_INTERVAL = 5.0 #or after this number of seconds
+
+class SweepJournal:
+    '''
+    Append only log of measured sweep points, fileName+'.part'.
+    First line is {"init": params}, then one {"period": requested period, "data": point} per line.
+    Every line is flushed, fsync is done in batches.
+    '''
+    def __init__(self, fileName, syncPoints=SWEEP_SYNC_POINTS, syncInterval=SWEEP_SYNC_INTERVAL):
+        self.fileName = fileName+'.part'
+        self.syncPoints = syncPoints
+        self.syncInterval = syncInterval
+        self.file = None
+        self.unsynced = 0
+        self.lastSync = time.time()
+        #valid part of existing journal found by read()
+        self.readParams = None
+        self.readPoints = None
+        self.readSize = 0
+        pass
 
-    print "period=", period
-    if count==None:
-        if period>=LOW_PASS_PERIOD:
-            count = 20
-        else:
-            count = 100
+    def read(self, params):
+        '''
+        return [(period, point)] of existing journal written with the same params,
+        incomplete last line is ignored
+        '''
+        self.readPoints = None
+        if not os.path.exists(self.fileName):
+            return []
+        points = []
+        f = open(self.fileName, 'rb')
+        data = f.read()
+        f.close()
+        pos = 0
+        while True:
+            end = data.find('\n', pos)
+            if end<0:
+                break
+            try:
+                jline = json.loads(data[pos:end])
+            except ValueError:
+                break
+            if 'init' in jline:
+                if jline['init']!=params:
+                    return []
+            else:
+                points.append((jline['period'], jline['data']))
+            pos = end+1
+        if pos==0:
+            return []
+        self.readParams = params
+        self.readPoints = points
+        self.readSize = pos
+        return points
+
+    def open(self, params, points=[]):
+        '''
+        Start journal with already measured points.
+        Journal just read with the same params and points is continued, only
+        incomplete last line is cut. Otherwise new journal is written to other file
+        and renamed, so points on disk are never lost.
+        '''
+        if self.readPoints is not None and self.readParams==params and self.readPoints==points:
+            self.file = open(self.fileName, 'r+b')
+            self.file.truncate(self.readSize)
+            self.file.seek(0, os.SEEK_END)
+            self.sync()
+            return
 
-    adcSynchro(period, inAmplitude=inAmplitude)
-    setLowPass(lowPass)
-    setGainAuto(maxAmplitude=maxAmplitude)
-    time.sleep(0.01)
-    return adcRequestLastComputeX(count)
+        tmpFileName = self.fileName+'.tmp'
+        self.file = open(tmpFileName, 'wb')
+        self.writeLine({"init": params})
+        for (period, point) in points:
+            self.writeLine({"period": period, "data": point})
+        self.sync()
+        self.file.close()
+        if os.name=='nt' and os.path.exists(self.fileName):
+            os.remove(self.fileName)
+        os.rename(tmpFileName, self.fileName)
+        self.file = open(self.fileName, 'ab')
+        pass
+
+    def writeLine(self, jline):
+        self.file.write(json.dumps(jline)+'\n')
+        self.file.flush()
+        pass
+
+    def append(self, period, point):
+        self.writeLine({"period": period, "data": point})
+        self.unsynced += 1
+        if self.unsynced>=self.syncPoints or time.time()-self.lastSync>=self.syncInterval:
+            self.sync()
+        pass
+
+    def sync(self):
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.lastSync = time.time()
+        pass
+
+    def close(self):
+        if self.file:
+            self.sync()
+            self.file.close()
+            self.file = None
+        pass
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.fileName):
+            os.remove(self.fileName)
+        pass
+
+    def exists(self):
+        return os.path.exists(self.fileName)
+
+    def backup(self):
+        '''
+        Move existing journal to fileName+'.part.bak', previous backup is replaced.
+        return backup file name
+        '''
+        backupFileName = self.fileName+'.bak'
+        if os.name=='nt' and os.path.exists(backupFileName):
+            os.remove(backupFileName)
+        os.rename(self.fileName, backupFileName)
+        return backupFileName
 
 class ScanFreq:
+    def __init__(self, session=None):
+        if session is None:
+            session = defaultSession
+        self.session = session
+        self.journal = None
+        pass
     def init(self, amplitude=DEFAULT_DAC_AMPLITUDE, resistorIndex=None,
              VIndex=None, IIndex=None, fileName='freq.json',
-             maxAmplitude=None):
-
+             maxAmplitude=None, resume=False, periods=None,
+             tolerance=None, minCount=ADAPTIVE_MIN_COUNT, maxCount=None):
+        '''
+        resume - continue sweep interrupted before save(),
+            periods found in fileName+'.part' journal are not measured again
+        periods - requested periods, periodAll() by default.
+            Measured in planSweep order, saved in frequency order.
+        tolerance - adaptive averaging of every point from minCount to maxCount computes,
+            see adcRequestLastComputeX
+        '''
+
+        self.amplitude = amplitude
         self.resistorIndex = resistorIndex
         self.VIndex = VIndex
         self.IIndex = IIndex
         self.fileName = fileName
         self.maxAmplitude = maxAmplitude
+        self.tolerance = tolerance
+        self.minCount = minCount
+        self.maxCount = maxCount
 
         #self.resistorIndex = 0
         #self.VIndex = 5
@@ -838,6 +1517,7 @@ class ScanFreq:
 
         self.jout = {}
         self.jfreq = []
+        self.jperiods = [] #requested period of every jfreq point
 
         self.jout['freq'] = self.jfreq
         #self.PERIOD_ROUND = period10Hz_100Hz()+period100Hz_1KHz()
@@ -846,62 +1526,246 @@ class ScanFreq:
         #self.PERIOD_ROUND = period100Khz_max()
         #self.PERIOD_ROUND = period10Khz_max()
         #self.PERIOD_ROUND = period90Khz_max()
-        self.PERIOD_ROUND = periodAll()
-        adcSynchro(self.PERIOD_ROUND[0], amplitude)
+        if periods is None:
+            periods = periodAll()
+        self.PERIOD_ALL = sorted(set(periods), reverse=True)
+        self.PERIOD_ROUND = self.PERIOD_ALL
+
+        params = { "amplitude": amplitude, "resistorIndex": resistorIndex,
+                   "VIndex": VIndex, "IIndex": IIndex }
+        if tolerance is not None:
+            params["tolerance"] = tolerance
+            params["minCount"] = minCount
+            params["maxCount"] = maxCount
+        self.journal = SweepJournal(fileName)
+        if not resume and self.journal.exists():
+            #partial work of interrupted sweep is kept
+            print "Unfinished sweep moved to", self.journal.backup(), \
+                  "rename it back to", self.journal.fileName, "and use resume=True to continue it"
+        points = []
+        if resume:
+            points = [(period, point) for (period, point) in self.journal.read(params)
+                      if period in self.PERIOD_ALL]
+        for (period, point) in points:
+            self.jperiods.append(period)
+            self.jfreq.append(point)
+        todo = [period for period in self.PERIOD_ALL if period not in self.jperiods]
+        self.PERIOD_ROUND = planSweep(todo, self.session.currentLowPass, self.planRangeOf())
+        self.journal.open(params, points)
+
         self.current_value = 0
-        time.sleep(0.2)
+        #session state may be stale before first point, low pass and relays are set anyway
+        self.forceSet = True
+        if self.PERIOD_ROUND:
+            self.session.adcSynchro(self.PERIOD_ROUND[0], amplitude)
+            self.session.sleep(0.2)
+        pass
+    def rangeOf(self, period):
+        '''
+        return (resistor, V gain, I gain) of fixed range sweep
+        '''
+        if self.maxAmplitude:
+            imax = self.maxAmplitude.getMaxGainI(self.resistorIndex, period)
+        else:
+            imax = self.IIndex
+        return (self.resistorIndex, self.VIndex, min(self.IIndex, imax))
+    def planRange(self, period):
+        '''
+        return expected range of period for planSweep, None if unknown
+        '''
+        if self.VIndex is None:
+            return self.session.rangeHints.range(period)
+        try:
+            return self.rangeOf(period)
+        except KeyError:
+            #no maxAmplitude data for requested period, next() uses real period
+            return None
+    def planRangeOf(self):
+        '''
+        return rangeOf for planSweep, auto range sweep is grouped by range only with session.rangeHints
+        '''
+        if self.VIndex is None and self.session.rangeHints is None:
+            return None
+        return self.planRange
+    def close(self):
+        '''
+        Close journal of cancelled or failed sweep, it stays for resume.
+        '''
+        if self.journal:
+            self.journal.close()
         pass
     def count(self):
         return len(self.PERIOD_ROUND)
     def current(self):
         return self.current_value        
     def next(self):
-        global currentLowPass
-
-        possiblePeriod = self.PERIOD_ROUND[self.current_value]
-        adcSynchro(possiblePeriod, amplitude)
-
-        oldLowPass = currentLowPass
-        if period>=LOW_PASS_PERIOD: #3 KHz
-            setLowPass(True)
-        else:
-            setLowPass(False)
-
-        #print period, oldLowPass, currentLowPass
-        if oldLowPass!=currentLowPass:
-            #print "time.sleep(1)"
-            time.sleep(1)
-
-        if self.VIndex is None:
-            if self.resistorIndex is None:
-                setGainAuto(maxAmplitude=self.maxAmplitude)
+        s = self.session
+        with s.lock:
+            if self.current_value>=self.count():
+                return False
+            possiblePeriod = self.PERIOD_ROUND[self.current_value]
+            #init already started DAC on first period
+            if s.synchroPeriod!=possiblePeriod or s.amplitude!=self.amplitude:
+                s.adcSynchro(possiblePeriod, self.amplitude)
+
+            oldLowPass = s.currentLowPass
+            lowPass = 1 if s.period>=LOW_PASS_PERIOD else 0 #3 KHz
+            if self.forceSet or lowPass!=oldLowPass:
+                s.setLowPass(lowPass)
+
+            #print period, oldLowPass, currentLowPass
+            if oldLowPass!=s.currentLowPass:
+                #print "time.sleep(1)"
+                s.sleep(1)
+
+            if self.VIndex is None:
+                if self.resistorIndex is None:
+                    s.setGainAuto(maxAmplitude=self.maxAmplitude)
+                else:
+                    s.setGainAuto(self.resistorIndex, maxAmplitude=self.maxAmplitude)
             else:
-                setGainAuto(self.resistorIndex, maxAmplitude=self.maxAmplitude)
-        else:
-            if self.maxAmplitude:
-                imax = self.maxAmplitude.getMaxGainI(self.resistorIndex, period)
+                (resistorIdx, idxV, idxI) = self.rangeOf(s.period)
+                if self.forceSet or s.resistorIdx!=resistorIdx:
+                    s.setResistor(resistorIdx)
+                if self.forceSet or s.gainVoltageIdx!=idxV:
+                    s.setSetGain(1, idxV) #V
+                if self.forceSet or s.gainCurrentIdx!=idxI:
+                    s.setSetGain(0, idxI) #I
+            self.forceSet = False
+
+            s.sleep(0.01)
+            if self.tolerance is not None:
+                jresult = s.adcRequestLastComputeX(tolerance=self.tolerance,
+                                                   minCount=self.minCount, maxCount=self.maxCount)
             else:
-                imax = self.IIndex
-
-            setResistor(self.resistorIndex)
-            setSetGain(1, self.VIndex) #V
-            setSetGain(0, min(self.IIndex, imax)) #I
-
-        time.sleep(0.01)
-        if period>=LOW_PASS_PERIOD:
-            count = 10
-        else:
-            count = 30
-        jresult = adcRequestLastComputeX(count)
-        #jresult = adcRequestLastComputeX(10)
-        self.jfreq.append(jresult)
-
-        self.current_value += 1
-        return self.current_value<self.count()
+                if s.period>=LOW_PASS_PERIOD:
+                    count = 10
+                else:
+                    count = 30
+                jresult = s.adcRequestLastComputeX(count)
+            #jresult = adcRequestLastComputeX(10)
+            if s.rangeHints is not None and self.VIndex is None:
+                s.rangeHints.addPoint(jresult)
+            self.jfreq.append(jresult)
+            self.jperiods.append(possiblePeriod)
+            self.journal.append(possiblePeriod, jresult)
+
+            self.current_value += 1
+            return self.current_value<self.count()
     def save(self):
-        f = open(self.fileName, 'w')
-        f.write(json.dumps(self.jout))
-        f.close()
+        #planned and resumed points are measured out of order
+        order = sorted(xrange(len(self.jfreq)), key=lambda i: self.PERIOD_ALL.index(self.jperiods[i]))
+        self.jfreq[:] = [self.jfreq[i] for i in order]
+        self.jperiods[:] = [self.jperiods[i] for i in order]
+
+        #write other file and rename, old file is never half written
+        tmpFileName = self.fileName+'.tmp'
+        if self.fileName.endswith('.npz'):
+            jplot.writeSweep(tmpFileName, self.jout)
+        else:
+            f = open(tmpFileName, 'w')
+            f.write(json.dumps(self.jout))
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+        if os.name=='nt' and os.path.exists(self.fileName):
+            os.remove(self.fileName)
+        os.rename(tmpFileName, self.fileName)
+        self.journal.remove()
+        if self.session.stats is not None:
+            self.session.stats.save(os.path.splitext(self.fileName)[0]+'_stats.json')
+
+ADAPTIVE_COARSE_POINTS = 13 #coarse grid of AdaptiveScanFreq
+ADAPTIVE_POINT_BUDGET = 100
+#change rates of Z per octave of frequency, pure L or C is log(2)=0.69 and 0 degrees
+ADAPTIVE_MAGNITUDE_RATE = 1.0 #abs(log(|Z2|/|Z1|)) per octave
+ADAPTIVE_PHASE_RATE = 20.0 #degrees per octave
+ADAPTIVE_MIN_PERIOD = 2*96
+ADAPTIVE_MAX_PERIOD = 720000
+
+def roundPeriod(period):
+    '''
+    Nearest period that is multiple of 96, like period* lists.
+    '''
+    return max(int(round(period/96.0))*96, 96)
+
+def coarsePeriods(minPeriod=ADAPTIVE_MIN_PERIOD, maxPeriod=ADAPTIVE_MAX_PERIOD, count=ADAPTIVE_COARSE_POINTS):
+    '''
+    Log spaced periods from maxPeriod to minPeriod, multiples of 96.
+    '''
+    periods = []
+    for i in xrange(count):
+        period = roundPeriod(maxPeriod*(float(minPeriod)/maxPeriod)**(i/float(max(count-1, 1))))
+        if period not in periods:
+            periods.append(period)
+    return periods
+
+class AdaptiveScanFreq(ScanFreq):
+    '''
+    ScanFreq that refines frequency grid where Z changes fast, for resonances
+    of inductors and crystals.
+    Coarse grid is measured first, then every pass inserts geometric middle period
+    between neighbours where |Z| or phase changes faster than magnitudeRate/phaseRate
+    per octave, fastest changes first, until pointBudget points are measured or every fast
+    interval is down to 96 period step.
+    Uncorrected R jumps a bit on range and low pass switch, pass corrector to refine on Zx.
+    resume restores only points of coarse grid.
+    '''
+    def init(self, minPeriod=ADAPTIVE_MIN_PERIOD, maxPeriod=ADAPTIVE_MAX_PERIOD,
+             coarse=ADAPTIVE_COARSE_POINTS, pointBudget=ADAPTIVE_POINT_BUDGET,
+             magnitudeRate=ADAPTIVE_MAGNITUDE_RATE, phaseRate=ADAPTIVE_PHASE_RATE,
+             corrector=None, **initArgs):
+        '''
+        initArgs - see ScanFreq.init
+        '''
+        self.pointBudget = pointBudget
+        self.magnitudeRate = magnitudeRate
+        self.phaseRate = phaseRate
+        self.corrector = corrector
+        periods = coarsePeriods(minPeriod, maxPeriod, coarse)[:pointBudget]
+        ScanFreq.init(self, periods=periods, **initArgs)
+        pass
+    def impedance(self, jf):
+        if self.corrector:
+            return self.corrector.calculateJson(jf)['Zx']
+        return calculateJson(jf)['R']
+    def refine(self):
+        '''
+        return new periods between neighbours with fast change of Z, within point budget
+        '''
+        free = self.pointBudget-len(self.jfreq)
+        if free<=0:
+            return []
+        Z = {}
+        for i in xrange(len(self.jfreq)):
+            Z[self.jperiods[i]] = self.impedance(self.jfreq[i])
+        periods = sorted(Z, reverse=True)
+
+        candidates = []
+        for (p1, p2) in zip(periods[:-1], periods[1:]):
+            middle = roundPeriod(math.sqrt(p1*p2))
+            if middle>=p1 or middle<=p2:
+                continue
+            (z1, z2) = (Z[p1], Z[p2])
+            if abs(z1)==0 or abs(z2)==0:
+                continue
+            octaves = math.log(float(p1)/p2, 2)
+            dmagnitude = abs(math.log(abs(z2)/abs(z1)))/octaves
+            dphase = abs(cmath.phase(z2/z1))*180.0/math.pi/octaves
+            score = max(dmagnitude/self.magnitudeRate, dphase/self.phaseRate)
+            if score>1:
+                candidates.append((score, middle))
+        candidates.sort(reverse=True)
+        return [middle for (score, middle) in candidates[:free]]
+    def next(self):
+        if ScanFreq.next(self):
+            return True
+        periods = self.refine()
+        if not periods:
+            return False
+        self.PERIOD_ALL = sorted(self.PERIOD_ALL+periods, reverse=True)
+        self.PERIOD_ROUND += planSweep(periods, self.session.currentLowPass, self.planRangeOf())
+        return True
 
 def printEndpoint(e):
     print "Endpoint:"
@@ -915,25 +1779,6 @@ def printEndpoint(e):
     print "bSynchAddress=", e.bSynchAddress
     pass
 
-def initDevice():
-    if not (dev is None):
-        return True
-
-    if not findDevice():
-        return False
-    dev.reset()
-    for cfg in dev:
-        for i in cfg:
-            print "interface=", i.bInterfaceNumber
-            for e in i:
-                print e.bEndpointAddress
-                #printEndpoint(e)
-
-    #for x in xrange(4):
-    #    print "write=",dwrite([1])
-    #    readOne()
-    return True    
-
 def main():
     if not initDevice():
         return
@@ -988,4 +1833,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-
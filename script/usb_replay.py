@@ -0,0 +1,261 @@
+# coding=UTF-8
+# Record USB traffic of MeterSession to file and replay it without hardware.
+#   record:  session = MeterSession(usb_replay.RecordingDevice(dev, 'sweep.usbrec'))
+#   replay:  session = usb_replay.ReplaySession('sweep.usbrec')
+#
+# Replay checks that every written command is the same as recorded,
+# so setGainAuto, ScanFreq and corrector upload (setCorrector) can be
+# regression tested at full CPU speed.
+#
+# File format: header '=4sHd' (magic, version, start time),
+# then records '=BdfH' (type, time from start, duration, size) followed by size bytes.
+import sys
+import time
+import struct
+import array
+import usb
+
+import jplot
+import usb_commands
+
+MAGIC = 'RLCU'
+VERSION = 1
+HEADER_FORMAT = '=4sHd'
+RECORD_FORMAT = '=BdfH'
+
+RECORD_WRITE = 1
+RECORD_READ = 2
+RECORD_READ_ERROR = 3 #payload is '=i' errno
+
+class ReplayError(Exception):
+    pass
+
+class RecordingDevice:
+    '''
+    Wraps pyusb device, passes everything to it and logs write/read.
+    '''
+    def __init__(self, dev, fileName):
+        self.dev = dev
+        self.file = open(fileName, 'wb')
+        self.startTime = time.time()
+        self.file.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, self.startTime))
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self.dev, name)
+
+    def __iter__(self):
+        return iter(self.dev)
+
+    def record(self, type, start, duration, data):
+        self.file.write(struct.pack(RECORD_FORMAT, type, start-self.startTime, duration, len(data)))
+        self.file.write(data)
+        pass
+
+    def write(self, endpoint, data, interface=0, timeout=None):
+        start = time.time()
+        n = self.dev.write(endpoint, data, interface=interface, timeout=timeout)
+        self.record(RECORD_WRITE, start, time.time()-start, array.array('B', data).tostring())
+        return n
+
+    def read(self, endpoint, size, interface=0, timeout=None):
+        start = time.time()
+        try:
+            data = self.dev.read(endpoint, size, interface=interface, timeout=timeout)
+        except usb.core.USBError as e:
+            self.record(RECORD_READ_ERROR, start, time.time()-start, struct.pack('=i', e.errno or 0))
+            raise
+        self.record(RECORD_READ, start, time.time()-start, array.array('B', data).tostring())
+        return data
+
+    def close(self):
+        self.file.close()
+        pass
+
+def readRecords(fileName):
+    '''
+    return (startTime, [(type, time, duration, payload)])
+    '''
+    f = open(fileName, 'rb')
+    data = f.read()
+    f.close()
+
+    (magic, version, startTime) = struct.unpack_from(HEADER_FORMAT, data, 0)
+    if magic!=MAGIC or version!=VERSION:
+        raise ReplayError('Bad record file '+fileName)
+
+    records = []
+    pos = struct.calcsize(HEADER_FORMAT)
+    recordSize = struct.calcsize(RECORD_FORMAT)
+    while pos<len(data):
+        (type, t, duration, size) = struct.unpack_from(RECORD_FORMAT, data, pos)
+        pos += recordSize
+        records.append((type, t, duration, data[pos:pos+size]))
+        pos += size
+    return (startTime, records)
+
+class ReplayDevice:
+    '''
+    Serves recorded reads in place of pyusb device.
+    strict - raise ReplayError if written command differs from recorded.
+    '''
+    def __init__(self, records, strict=True):
+        self.records = records
+        self.pos = 0
+        self.strict = strict
+        self.firstCallTime = None
+        self.lastCallTime = None
+        pass
+
+    def set_configuration(self):
+        pass
+
+    def reset(self):
+        pass
+
+    def __iter__(self):
+        return iter([])
+
+    def nextRecord(self, types):
+        now = time.time()
+        if self.firstCallTime is None:
+            self.firstCallTime = now
+        self.lastCallTime = now
+
+        if self.pos>=len(self.records):
+            raise ReplayError('End of record at {}'.format(self.pos))
+        rec = self.records[self.pos]
+        if rec[0] not in types:
+            raise ReplayError('Record {} type {} expected {}'.format(self.pos, rec[0], types))
+        self.pos += 1
+        return rec
+
+    def write(self, endpoint, data, interface=0, timeout=None):
+        rec = self.nextRecord((RECORD_WRITE,))
+        data = array.array('B', data).tostring()
+        if self.strict and data!=rec[3]:
+            raise ReplayError('Record {} write {} recorded {}'.format(self.pos-1,
+                              repr(data), repr(rec[3])))
+        return len(data)
+
+    def read(self, endpoint, size, interface=0, timeout=None):
+        rec = self.nextRecord((RECORD_READ, RECORD_READ_ERROR))
+        if rec[0]==RECORD_READ_ERROR:
+            errno = struct.unpack('=i', rec[3])[0]
+            raise usb.core.USBError('Replayed error', errno=errno)
+        return array.array('B', rec[3])
+
+    def complete(self):
+        return self.pos>=len(self.records)
+
+class ReplaySession(usb_commands.MeterSession):
+    '''
+    MeterSession on recorded traffic, sleeps are skipped.
+    '''
+    def __init__(self, fileName, strict=True):
+        (self.recordStartTime, records) = readRecords(fileName)
+        usb_commands.MeterSession.__init__(self, ReplayDevice(records, strict))
+        self.skippedSleep = 0.0
+        pass
+
+    def sleep(self, seconds):
+        if self.stats is not None:
+            self.stats.addSleep(seconds)
+        self.skippedSleep += seconds
+        pass
+
+    def report(self):
+        '''
+        Split time of recorded session.
+        host - replay time, it is time of host code without USB and sleep.
+        usb - time in recorded write/read.
+        wait - the rest, sleeps and waiting for device.
+        '''
+        records = self.dev.records[:self.dev.pos]
+        if not records:
+            return None
+        recorded = records[-1][1]+records[-1][2]-records[0][1]
+        usbTime = sum(rec[2] for rec in records)
+        host = self.dev.lastCallTime-self.dev.firstCallTime
+        wait = max(recorded-usbTime-host, 0)
+        return {
+            "recorded": recorded,
+            "usb": usbTime,
+            "host": host,
+            "wait": wait,
+            "hostPart": host/recorded if recorded>0 else 0,
+        }
+
+def printReport(report):
+    print "recorded=", report['recorded'], "usb=", report['usb'], \
+          "host=", report['host'], "wait=", report['wait'], \
+          "host overhead={:.1f}%".format(report['hostPart']*100)
+
+def replayScan(recordFileName, corrector=None, fileName='freq_replay.json', **initArgs):
+    '''
+    Replay recorded ScanFreq.
+    initArgs must be the same as in recorded ScanFreq.init.
+    return (results of calculateJson for every frequency, report)
+    '''
+    session = ReplaySession(recordFileName)
+    sc = usb_commands.ScanFreq(session)
+    sc.init(fileName=fileName, **initArgs)
+    while sc.next():
+        pass
+    sc.save()
+
+    result = []
+    for jf in sc.jfreq:
+        if corrector:
+            result.append(corrector.calculateJson(jf))
+        else:
+            result.append(jplot.calculateJson(jf))
+    return (result, session.report())
+
+def replayGainAuto(recordFileName, predefinedRes=-1, maxAmplitude=None):
+    '''
+    Replay recorded adcSynchro+setGainAuto.
+    return ((resistorIdx, gainVoltageIdx, gainCurrentIdx), report)
+    '''
+    session = ReplaySession(recordFileName)
+    cmd = array.array('B', session.dev.records[0][3])
+    (period, amplitude) = struct.unpack_from('=IH', cmd, 1)
+    session.adcSynchro(period, amplitude)
+    session.setGainAuto(predefinedRes, maxAmplitude)
+    return ((session.resistorIdx, session.gainVoltageIdx, session.gainCurrentIdx), session.report())
+
+def recordScan(recordFileName, dev=None, **initArgs):
+    '''
+    Record ScanFreq on real device (or given device, for example simulator.SimulatedDevice).
+    '''
+    if dev is None:
+        dev = usb.core.find(idVendor=usb_commands.USB_VENDOR_ID, idProduct=usb_commands.USB_PRODUCT_ID)
+        if dev is None:
+            print 'Device not found'
+            return False
+        dev.set_configuration()
+    rec = RecordingDevice(dev, recordFileName)
+    session = usb_commands.MeterSession(rec)
+    sc = usb_commands.ScanFreq(session)
+    sc.init(**initArgs)
+    while sc.next():
+        print sc.current(), '/', sc.count()
+    sc.save()
+    rec.close()
+    return True
+
+def main():
+    if len(sys.argv)<3:
+        print 'usage: usb_replay.py record|replay file.usbrec'
+        return
+    if sys.argv[1]=='record':
+        recordScan(sys.argv[2])
+    elif sys.argv[1]=='replay':
+        (result, report) = replayScan(sys.argv[2])
+        for res in result:
+            print "F=", res['F'], "R=", res['R']
+        printReport(report)
+    pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# coding=UTF-8
+# Timing of USB transfers and meter commands.
+#   session.stats = usb_stats.UsbStats()
+import math
+import json
+
+HISTOGRAM_BUCKETS = 24 #log2 buckets from 1 us to 8 s
+
+class CallStats:
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.maxTime = 0.0
+        self.bytes = 0
+        self.histogram = [0]*HISTOGRAM_BUCKETS
+        pass
+
+    def add(self, dt, nbytes):
+        self.count += 1
+        self.time += dt
+        self.maxTime = max(self.maxTime, dt)
+        self.bytes += nbytes
+        us = dt*1e6
+        if us<1:
+            idx = 0
+        else:
+            idx = min(int(math.log(us, 2))+1, HISTOGRAM_BUCKETS-1)
+        self.histogram[idx] += 1
+        pass
+
+    def toJson(self):
+        jhist = {}
+        for idx in xrange(HISTOGRAM_BUCKETS):
+            if self.histogram[idx]>0:
+                jhist['<{}us'.format(2**idx)] = self.histogram[idx]
+        return {
+            "count": self.count,
+            "time": self.time,
+            "mean": self.time/self.count if self.count>0 else 0,
+            "max": self.maxTime,
+            "bytes": self.bytes,
+            "histogram": jhist,
+        }
+
+class UsbStats:
+    '''
+    Call counts, bytes and latency histograms per transfer and per command.
+    Command time includes nested commands, for example setGainAuto
+    includes its adcRequestLastCompute calls.
+    '''
+    def __init__(self):
+        self.calls = {}
+        self.sleepTime = 0.0
+        self.sleepCount = 0
+        pass
+
+    def addCall(self, name, dt, nbytes=0):
+        if name not in self.calls:
+            self.calls[name] = CallStats()
+        self.calls[name].add(dt, nbytes)
+        pass
+
+    def addSleep(self, dt):
+        self.sleepTime += dt
+        self.sleepCount += 1
+        pass
+
+    def toJson(self):
+        jcalls = {}
+        for name in self.calls:
+            jcalls[name] = self.calls[name].toJson()
+        return {
+            "calls": jcalls,
+            "sleep": { "count": self.sleepCount, "time": self.sleepTime },
+        }
+
+    def save(self, fileName):
+        f = open(fileName, 'w')
+        f.write(json.dumps(self.toJson(), indent=1, sort_keys=True))
+        f.close()